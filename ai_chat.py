@@ -1,9 +1,15 @@
-import phonenumbers
-import dateparser
-from pydantic import BaseModel, Field
+import abc
+import datetime
+import json
+import re
+import threading
+import time
+import uuid
+from pydantic import BaseModel, Field, ValidationError, create_model
 from typing import  Optional
-from openai import OpenAI # needed only for API conformity for instructor.
-import instructor
+from validation_cache import ValidationCache
+from form_schema import load_form_schema
+import instrumentation
 
 class ChatInfo(BaseModel):
     """
@@ -13,150 +19,370 @@ class ChatInfo(BaseModel):
     is_valid: bool = Field(description="Whether this is valid.")
     error_message: Optional[str] = Field(description="Error message, if any.")
 
-class ChatBot:
+# Country names and nationality adjectives that can be accepted without asking
+# the model, mapped to the English country name the model is asked to return.
+COUNTRY_NAMES = {
+    "japan": "Japan", "japanese": "Japan",
+    "united states of america": "United States of America",
+    "united states": "United States of America", "usa": "United States of America",
+    "us": "United States of America", "america": "United States of America",
+    "american": "United States of America",
+    "china": "China", "chinese": "China",
+    "south korea": "South Korea", "korea": "South Korea", "korean": "South Korea",
+    "south korean": "South Korea",
+    "taiwan": "Taiwan", "taiwanese": "Taiwan",
+    "india": "India", "indian": "India",
+    "nepal": "Nepal", "nepali": "Nepal", "nepalese": "Nepal",
+    "vietnam": "Vietnam", "viet nam": "Vietnam", "vietnamese": "Vietnam",
+    "philippines": "Philippines", "filipino": "Philippines", "philippine": "Philippines",
+    "indonesia": "Indonesia", "indonesian": "Indonesia",
+    "thailand": "Thailand", "thai": "Thailand",
+    "myanmar": "Myanmar", "burmese": "Myanmar",
+    "sri lanka": "Sri Lanka", "sri lankan": "Sri Lanka",
+    "bangladesh": "Bangladesh", "bangladeshi": "Bangladesh",
+    "pakistan": "Pakistan", "pakistani": "Pakistan",
+    "mongolia": "Mongolia", "mongolian": "Mongolia",
+    "malaysia": "Malaysia", "malaysian": "Malaysia",
+    "singapore": "Singapore", "singaporean": "Singapore",
+    "brazil": "Brazil", "brazilian": "Brazil",
+    "peru": "Peru", "peruvian": "Peru",
+    "mexico": "Mexico", "mexican": "Mexico",
+    "canada": "Canada", "canadian": "Canada",
+    "united kingdom": "United Kingdom", "uk": "United Kingdom", "british": "United Kingdom",
+    "france": "France", "french": "France",
+    "germany": "Germany", "german": "Germany",
+    "italy": "Italy", "italian": "Italy",
+    "spain": "Spain", "spanish": "Spain",
+    "russia": "Russia", "russian": "Russia",
+    "australia": "Australia", "australian": "Australia",
+    "new zealand": "New Zealand",
+}
+
+def validate_date_locally(user_input):
     """
-    A chatbot to help fill out a letter of guarantee form. 
-    Uses the Instructor API to validate and extract data from user input with a Llama 3.1-8b model.
-    It will ask questions one by one, validate the input, and save the data.
+    Accepts a complete date (day, month and year) that dateparser can read.
+    All numeric dates are only accepted year first, since 01/05/2024 could be
+    either January 5th or May 1st, and are read strictly as year, month, day.
+
+    Args:
+        user_input (str): The user's input.
+
+    Returns:
+        str: The date as YYYY-MM-DD, or None if the input is ambiguous.
     """
-    def __init__(self):
-        self.model_name = "llama3.1:8b"
-        self.instructor_client = instructor.from_openai(
-            OpenAI(
-                base_url="http://localhost:11434/v1",
-                api_key="ollama",  # required, but unused
-            ),
-            mode=instructor.Mode.JSON,
-        )
-        self.form_data = {
-            "date" : {
-                "base_prompt" : "What date do you want to put on this form?",
-                "description" : "Date for this form.",
-                "validation_rule" : "Should be a valid date in any format.",
-            },
-            "full_name" : {
-                "base_prompt" : "What is your full name?",
-                "description" : "Full name of the person filling this form.",
-                "validation_rule" : "Must have first name and last name."
-            },
-            "nationality" : {
-                "base_prompt" : "What is your nationality?",
-                "description" : "Nationality of the person filling this form.",
-                "validation_rule" : "Check against a list of countries if the input is a valid country. "
-                                    "Convert adjective to noun if needed, e.g. 'Japanese' to 'Japan', or 'American' to 'United States of America'. "
-                                    "The name of the country should be a valid name in English.",
-            },
-            "guarantor" : {
-                "nested" : True,
-                "name": {
-                    "description": "The full name of the guarantor.",
-                    "base_prompt": "Could you please provide the full name of your guarantor?",
-                    "validation_rule" : "The name must be a non-empty string. It should at least contain a first name and a last name."
-                },
-                "address_in_japan": {
-                    "description": "The address of the guarantor in Japan.",
-                    "base_prompt": "What is the address of your guarantor in Japan? Please provide the full address including postal code.",
-                    "validation_rule" : "The address should be a valid address in Japan in the format Postal Code, Prefecture, City, Building Name (if applicable)."
-                                        "Save the address in the format 'Postal Code, Prefecture, City, Building Name (if applicable)'. Do not make any changes to core elements of the address, such as postal code, prefecture, city, or building name."
-                                        "Do not use key-value pairs, just a single string."
-                },
-                "guarantor_phone_number": {
-                    "description": "The phone number of the guarantor in Japan.",
-                    "base_prompt": "What is your guarantor's phone number in Japan?",
-                    "validation_rule" :"""1. The phone number should be a valid Japanese phone number. It should start with a country code +81 or 0, followed by 9 to 11 digits.
-2. For 'field': Return the EXACT input with only formatting changes if needed (like adding hyphens)
-3. If you need to reformat, only add separators - NEVER change digits
-4. If the input is invalid, set is_valid to False but still preserve the original digits in 'field'"""
-                },
-                "place_of_employment": {
-                    "description": "The place of employment of the guarantor.",
-                    "base_prompt": "Where does your guarantor work?",
-                    "validation_rule" : "The place of employment can be a company name, organization, or institution. It should not be empty."
-                },
-                "occupation_phone_number": {
-                    "description": "The phone number of the guarantor's place of employment.",
-                    "base_prompt": "What is the phone number of your guarantor's place of employment?",
-                    "validation_rule" :"""1. The phone number should be a valid Japanese phone number. It should start with a country code +81 or 0, followed by 9 to 11 digits.
-2. For 'field': Return the EXACT input with only formatting changes if needed (like adding hyphens)
-3. If you need to reformat, only add separators - NEVER change digits
-4. If the input is invalid, set is_valid to False but still preserve the original digits in 'field'"""
-                },
-                "nationality": {
-                    "description": "The nationality of the guarantor.",
-                    "base_prompt": "What is your guarantor's nationality?",
-                    "validation_rule" : "Check against a list of countries if the input is a valid country. "
-                                        "Convert adjective to noun if needed, e.g. 'Japanese' to 'Japan', or 'American' to 'United States of America'. "
-                                        "The name of the country should be a valid name in English.",
-                },
-                "status_of_residence": {
-                    "description": "The status of residence of the guarantor.",
-                    "base_prompt": "What is your guarantor's status of residence in Japan?",
-                    "validation_rule" : "Check against a list of valid statuses of residence in Japan. It should be a valid status such as 'Permanent Resident', 'Student', 'Work Visa', etc. If the guarantor is not a Japanese citizen, it should be specified."
-                },
-                "period_of_stay": {
-                    "description": "The period of stay of the guarantor if they are not a Japanese citizen.",
-                    "base_prompt": "If your guarantor is not a Japanese citizen, what is their period of stay in Japan? Please provide the start and end dates.",
-                    "validation_rule" : "Should be a valid date range. If the guarantor is a Japanese citizen, this field can be left empty."
-                },
-                "guarantor_relationship": {
-                    "description": "The relationship of the guarantor to the user.",
-                    "base_prompt": "What is your relationship with the guarantor?",
-                    "validation_rule" : "The relationship should be a valid relationship such as 'Parent', 'Sibling', 'Friend', 'Colleague', etc. It should not be empty."
-                }   
-            }
-        }
-        self.flat_fields = self._parse_form_fields("", self.form_data)
+    if not re.search(r"[^\W\d_]", user_input):
+        match = re.fullmatch(r"\s*(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})\s*", user_input)
+        if match is None:
+            return None
+        try:
+            return datetime.date(*map(int, match.groups())).strftime("%Y-%m-%d")
+        except ValueError:
+            # e.g. 2024-13-01, which dateparser would read as 2024-01-13.
+            return None
+
+    import dateparser
+
+    parsed = dateparser.parse(user_input, settings={"STRICT_PARSING": True})
+    if parsed is None:
+        return None
+
+    return parsed.strftime("%Y-%m-%d")
+
+def validate_phone_number_locally(user_input):
+    """
+    Accepts a phone number that phonenumbers considers a valid Japanese number.
+
+    Args:
+        user_input (str): The user's input.
+
+    Returns:
+        str: The number as +<country code>-<national number>, or None if the input is ambiguous.
+    """
+    import phonenumbers
+
+    try:
+        parsed_number = phonenumbers.parse(user_input, "JP")
+    except phonenumbers.NumberParseException:
+        return None
+    if parsed_number.country_code != 81 or not phonenumbers.is_valid_number(parsed_number):
+        return None
+
+    return f"+{parsed_number.country_code}-{parsed_number.national_number}"
+
+def validate_nationality_locally(user_input):
+    """
+    Accepts a country name or nationality adjective found in COUNTRY_NAMES.
+
+    Args:
+        user_input (str): The user's input.
+
+    Returns:
+        str: The English country name, or None if the input is ambiguous.
+    """
+    return COUNTRY_NAMES.get(" ".join(user_input.lower().replace(".", "").split()))
+
+# Validators that are tried before the model, referenced by name from the
+# "local_validator" key of a form field. A validator returns the value to
+# save, or None when the input needs the model.
+LOCAL_VALIDATORS = {
+    "date": validate_date_locally,
+    "phone_number": validate_phone_number_locally,
+    "nationality": validate_nationality_locally,
+}
+
+# OpenAI compatible endpoint of the local Ollama server.
+OLLAMA_BASE_URL = "http://localhost:11434/v1"
+
+# Error shown when the model rejects an answer without saying why.
+INVALID_ANSWER_MESSAGE = "This answer does not look valid. Please check it and try again."
+
+# Error shown when the model could not produce a valid response within the retry policy.
+MODEL_FAILURE_MESSAGE = "Sorry, I could not process that answer right now. Could you please rephrase it?"
+
+def _unwrap_model_error(error):
+    """
+    instructor wraps every failed attempt, including transport and API errors,
+    in InstructorRetryException around a tenacity RetryError.
+
+    Returns:
+        Exception: The error that actually made the model call fail.
+    """
+    from instructor.exceptions import InstructorRetryException
+
+    seen = set()
+    while id(error) not in seen:
+        seen.add(id(error))
+        last_attempt = getattr(error, "last_attempt", None)  # tenacity.RetryError
+        if last_attempt is not None and last_attempt.failed:
+            cause = last_attempt.exception()
+        elif isinstance(error, InstructorRetryException):
+            cause = error.__cause__ or error.__context__
+        else:
+            break
+        if cause is None:
+            break
+        error = cause
+
+    return error
+
+class RetryPolicy:
+    """
+    How model calls are retried. A call is only retried when the model returns
+    output that does not match the response schema. Each model in models is
+    tried retries_per_model + 1 times before escalating to the next one, and
+    the whole turn is bounded by latency_budget_seconds.
+
+    For example RetryPolicy(models=("llama3.2:3b", "llama3.1:8b")) tries a
+    small fast model first and escalates to the 8B model on failure.
+    """
+    def __init__(self, models=("llama3.1:8b",), retries_per_model=2, latency_budget_seconds=20.0):
+        """
+        Args:
+            models (tuple): The model names to try, in order.
+            retries_per_model (int): Retries on schema errors before escalating.
+            latency_budget_seconds (float): The maximum time spent on one turn,
+                or None for no limit.
+        """
+        self.models = tuple(models)
+        self.retries_per_model = retries_per_model
+        self.latency_budget_seconds = latency_budget_seconds
+
+    def attempts(self):
+        """
+        Yields:
+            str: The model to use for each attempt, in order.
+        """
+        for model in self.models:
+            for _ in range(self.retries_per_model + 1):
+                yield model
+
+class ChatSession:
+    """
+    The progress of one applicant through the form. Kept separate from the
+    bot so that one bot can serve many sessions cheaply.
+    """
+    __slots__ = ("session_id", "saved_info", "current_field_index")
+
+    def __init__(self, session_id=None):
+        """
+        Args:
+            session_id (str): The id the session is persisted under, or None.
+        """
+        self.session_id = session_id
         self.saved_info = dict()
         self.current_field_index = 0
 
-    def _parse_form_fields(self, prefix, form_dict):
+class _ChatBotBase(abc.ABC):
+    """
+    The form logic shared by ChatBot and AsyncChatBot: the schema, local and
+    model validation of answers, saving them into sessions, and the statistics.
+    Subclasses provide the model client and the turn methods, which are
+    blocking in ChatBot and coroutines in AsyncChatBot.
+    """
+    def __init__(self, local_validators=None, cache=None, base_url=OLLAMA_BASE_URL, schema=None,
+                 retry_policy=None, session_store=None):
+        """
+        Args:
+            local_validators (dict): Validators tried before the model, by name.
+                Defaults to LOCAL_VALIDATORS.
+            cache (ValidationCache): Cache of model responses. None disables caching.
+            base_url (str): The OpenAI compatible endpoint serving the model.
+            schema (FormSchema): The form to fill. Defaults to the letter of guarantee.
+            retry_policy (RetryPolicy): How model calls are retried. Defaults to
+                retrying model_name on schema errors within a latency budget.
+            session_store: A DictSessionStore or SQLiteSessionStore every saved
+                field is written to, so that sessions can be resumed. None keeps
+                sessions in memory only.
+        """
+        self.model_name = "llama3.1:8b"
+        self.retry_policy = RetryPolicy(models=(self.model_name,)) if retry_policy is None else retry_policy
+        self.local_validators = LOCAL_VALIDATORS if local_validators is None else local_validators
+        self.cache = cache
+        self.base_url = base_url
+        self._instructor_client = None
+        self._client_lock = threading.Lock()
+        self.schema = load_form_schema() if schema is None else schema
+        self.form_data = self.schema.form_data
+        self.flat_fields = self.schema.flat_fields
+        self._validators = {field.name: self.local_validators.get(field.local_validator)
+                            for field in self.schema.fields}
+        self.session_store = session_store
+        self.fast_path_turns = 0
+        self.llm_turns = 0
+        self.llm_seconds = 0.0
+        self.retries_per_field = dict()
+        self.turn_latencies = list()
+        self.failed_turns = 0
+
+    @abc.abstractmethod
+    def _make_client(self, base_url):
+        """
+        Creates the instructor client used to talk to the model.
+
+        Args:
+            base_url (str): The OpenAI compatible endpoint serving the model.
+
+        Returns:
+            The instructor client.
+        """
+
+    @property
+    def instructor_client(self):
+        """
+        The instructor client. It is created on first use, or by warm_up(),
+        because importing openai and instructor takes about a second.
+        """
+        if self._instructor_client is None:
+            with self._client_lock:
+                if self._instructor_client is None:
+                    self._instructor_client = self._make_client(self.base_url)
+
+        return self._instructor_client
+
+    def _warm_up(self, keep_alive):
+        """
+        Loads the slow imports and the client, and asks Ollama to load the
+        model. Blocks until done, so it is run on a worker thread.
+
+        Args:
+            keep_alive (str): How long Ollama keeps the model loaded.
+        """
+        import urllib.request
+        import dateparser
+        import phonenumbers
+
+        # The first parse also loads dateparser's language data.
+        dateparser.parse("2024-01-01", settings={"STRICT_PARSING": True})
+        self.instructor_client
+
+        # A generate request without a prompt only loads the model.
+        ollama_url = self.base_url.rstrip("/").removesuffix("/v1")
+        request = urllib.request.Request(
+            f"{ollama_url}/api/generate",
+            data=json.dumps({"model": self.retry_policy.models[0], "keep_alive": keep_alive}).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            urllib.request.urlopen(request, timeout=60).close()
+        except OSError:
+            # The server may not be Ollama, or not running yet.
+            pass
+
+    def _create_session(self):
+        """
+        Returns:
+            ChatSession: A new session, with an id if there is a session store.
+            The store only registers it when its first field is saved, so
+            sessions that are resumed instead or never answered leave no rows.
+        """
+        if self.session_store is None:
+            return ChatSession()
+
+        return ChatSession(uuid.uuid4().hex)
+
+    def _restore_session(self, session_id):
         """
-        Recursively flattens the form fields, including nested fields, into a list of dot-separated field names.
+        Rebuilds a session from the session store. The current field is the
+        first field without a saved value, as when the session was left.
 
         Args:
-            prefix (str): The prefix for nested fields.
-            form_dict (dict): The dictionary representing the form structure.
+            session_id (str): The id of the session.
 
         Returns:
-            list: A list of flattened field names.
+            ChatSession: The restored session.
+
+        Raises:
+            KeyError: If the session is not in the store.
         """
-        flat_fields = list()
-        for k, v in form_dict.items():
-            if isinstance(v, dict) and v.get('nested'):
-                flat_fields += self._parse_form_fields(f"{prefix}{k}.", form_dict[k])
-            elif k != "nested":
-                flat_fields.append(prefix + k)
+        fields = self.session_store.load(session_id) if self.session_store is not None else None
+        if fields is None:
+            raise KeyError(f"Unknown session {session_id}")
 
-        return flat_fields
+        session = ChatSession()
+        for field_name, value in fields.items():
+            self._save_info(value, field_name, session)
+        session.session_id = session_id
+        while session.current_field_index < len(self.flat_fields) and \
+                self._saved_value(session, self.flat_fields[session.current_field_index]) is not None:
+            session.current_field_index += 1
+
+        return session
+
+    def _resume_reply(self, session):
+        """
+        Returns:
+            tuple: (bot_reply (str), is_complete (bool)) greeting a resumed session.
+        """
+        if session.current_field_index == len(self.flat_fields):
+            return "Welcome back! The form is already complete.", True
+
+        form_field = self._find_form_data(self.flat_fields[session.current_field_index])
+        return f"Welcome back! Let's continue where we left off.\n\n{form_field.base_prompt}", False
 
     def _find_form_data(self, current_field):
         """
-        Retrieves the form field metadata dictionary for a given dot-separated field name.
+        Retrieves the compiled form field for a given dot-separated field name.
 
         Args:
             current_field (str): The dot-separated field name.
 
         Returns:
-            dict: The metadata dictionary for the field.
+            FormField: The compiled field.
         """
-        keys = current_field.split(".")
-        form_dict = self.form_data
-        
-        for k in keys:
-            form_dict = form_dict[k]
-
-        return form_dict
+        return self.schema[current_field]
     
-    def _save_info(self, value, field_name):
+    def _save_info(self, value, field_name, session):
         """
-        Saves the validated value into the saved_info dictionary at the correct nested location.
+        Saves the validated value into the saved_info dictionary at the correct nested location,
+        and writes it to the session store if the session is persisted.
 
         Args:
             value: The value to save.
             field_name (str): The dot-separated field name.
+            session (ChatSession): The session to save into.
         """
-        keys = field_name.split(".")
-        store = self.saved_info
+        keys = self.schema[field_name].path
+        store = session.saved_info
 
         for k in keys[:-1]:
             if k not in store:
@@ -164,16 +390,557 @@ class ChatBot:
             store = store[k]
         store[keys[-1]] = value
 
+        if session.session_id is not None and self.session_store is not None:
+            self.session_store.save_field(session.session_id, field_name, value)
+
+    def _validation_messages(self, field_data, user_input):
+        """
+        Builds the messages asking the model to validate the user's input for a field.
+
+        Args:
+            field_data (FormField): The compiled field.
+            user_input (str): The user's input.
+
+        Returns:
+            list: The chat messages.
+        """
+        return [
+            {
+                "role" : "system",
+                "content" : field_data.system_prompt
+            },
+            {
+                "role" : "user",
+                "content" : f"{user_input}"
+            }
+        ]
+
+    def _remaining_budget(self, start):
+        """
+        Returns:
+            float: Seconds left of the turn's latency budget, or None without a budget.
+        """
+        if self.retry_policy.latency_budget_seconds is None:
+            return None
+
+        return self.retry_policy.latency_budget_seconds - (time.perf_counter() - start)
+
+    def _record_attempts(self, field_name, retries, failed, seconds):
+        """
+        Records the retries and latency spent on one model turn.
+        """
+        self.retries_per_field[field_name] = self.retries_per_field.get(field_name, 0) + retries
+        self.turn_latencies.append(seconds)
+        if failed:
+            self.failed_turns += 1
+
+    def _validate_locally(self, session, user_input):
+        """
+        Validates the user's input for the current field of a session without
+        the model, if the field has a local validator.
+
+        Args:
+            session (ChatSession): The session the input belongs to.
+            user_input (str): The user's input.
+
+        Returns:
+            The normalized value if the input is confidently valid, otherwise None.
+        """
+        validator = self._validators[self.flat_fields[session.current_field_index]]
+        return validator(user_input) if validator else None
+
+    def _begin_turn(self, session, local_value):
+        """
+        Starts processing a user turn, saving the input right away if it was
+        validated locally.
+
+        Args:
+            session (ChatSession): The session the input belongs to.
+            local_value: The result of _validate_locally() for the input.
+
+        Returns:
+            tuple: (current_field (str), field_data (FormField), reply), where reply is
+            the (bot_reply, is_complete) tuple if the turn is already done, or None
+            if the model has to validate the input.
+        """
+        current_field = self.flat_fields[session.current_field_index]
+        field_data = self._find_form_data(current_field)
+
+        if local_value is not None:
+            # Confidently valid input is saved as is, without a model round trip.
+            self.fast_path_turns += 1
+            self._save_info(local_value, current_field, session)
+            return current_field, field_data, self._advance(session, current_field, local_value)
+
+        return current_field, field_data, None
+
+    def _cached_response(self, field_data, user_input):
+        """
+        Args:
+            field_data (FormField): The compiled field.
+            user_input (str): The user's input.
+
+        Returns:
+            tuple: (cache key, cached ChatInfo or None). The key is None for
+            fields that are not cacheable, so their responses are never stored.
+        """
+        if self.cache is None or not field_data.cacheable:
+            return None, None
+
+        # Keyed by every model of the policy, since any of them may have answered.
+        cache_key = self.cache.make_key(",".join(self.retry_policy.models), field_data, user_input)
+        return cache_key, self.cache.get(cache_key, ChatInfo)
+
+    def _record_llm_response(self, cache_key, response, seconds):
+        """
+        Records the latency of a model call and caches its response. Replies
+        given when the model failed within the retry policy are not cached.
+        """
+        self.llm_turns += 1
+        self.llm_seconds += seconds
+        if self.cache is not None and cache_key is not None and \
+                getattr(response, "error_message", None) != MODEL_FAILURE_MESSAGE:
+            self.cache.put(cache_key, response)
+
+    def _normalize_value(self, field_name, value):
+        """
+        Brings a value the model accepted into the format saved on the form.
+
+        Args:
+            field_name (str): The dot-separated field name.
+            value (str): The value extracted by the model.
+
+        Returns:
+            tuple: (normalized value (str), error message (str) or None)
+        """
+        # Fields are normalized like their local validator would save them.
+        local_validator = self.schema[field_name].local_validator
+        if local_validator == "date":
+            import dateparser
+
+            parsed = dateparser.parse(value)
+            if parsed is None:
+                return value, f"The date provided {value}, could not be understood. Please provide a valid date."
+            return parsed.strftime("%Y-%m-%d"), None
+        elif local_validator == "phone_number":
+            import phonenumbers
+
+            parsed_number = phonenumbers.parse(value, "JP")
+            if phonenumbers.is_valid_number(parsed_number):
+                return f"+{parsed_number.country_code}-{parsed_number.national_number}", None
+            return value, f"The phone number provided {value}, is not valid. Please provide a valid Japanese phone number."
+
+        return value, None
+
+    def _finish_turn(self, session, current_field, field_data, response):
+        """
+        Saves the model's validated response, or asks again if it was invalid.
+
+        Args:
+            session (ChatSession): The session the input belongs to.
+            current_field (str): The dot-separated name of the current field.
+            field_data (FormField): The compiled field.
+            response (ChatInfo): The model's response.
+
+        Returns:
+            tuple: (bot_reply (str), is_complete (bool))
+        """
+        if response.is_valid:
+            valid_response, error_message = self._normalize_value(current_field, response.field)
+            if error_message is not None:
+                response.is_valid = False
+                response.error_message = error_message
+                return f"That did not work out quite well for the following reason:\n{response.error_message}\n\nLets try again. {field_data.base_prompt}", False
+
+            self._save_info(valid_response, current_field, session)
+
+            return self._advance(session, current_field, valid_response)
+
+        bot_reply = f"""That did not work out quite well for the following reason:
+{response.error_message or INVALID_ANSWER_MESSAGE}
+
+Lets try again. {field_data.base_prompt}"""
+
+        return bot_reply, False
+
+    def _advance(self, session, current_field, valid_response):
+        """
+        Moves on to the next field after a value has been saved for the current one.
+
+        Args:
+            session (ChatSession): The session to advance.
+            current_field (str): The dot-separated name of the field that was saved.
+            valid_response (str): The saved value.
+
+        Returns:
+            tuple: (bot_reply (str), is_complete (bool))
+        """
+        session.current_field_index += 1
+
+        bot_reply = f"Thank you! The data has been saved as {valid_response}."
+        if session.current_field_index < len(self.flat_fields):
+            self._apply_skip_rules(session)
+
+            # Skip fields that are already saved, e.g. by extract_fields().
+            while session.current_field_index < len(self.flat_fields) and \
+                    self._saved_value(session, self.flat_fields[session.current_field_index]) is not None:
+                session.current_field_index += 1
+
+        if session.current_field_index < len(self.flat_fields):
+            next_field = self.flat_fields[session.current_field_index]
+            if "guarantor" in next_field and "guarantor" not in current_field:
+                bot_reply += "\n\nNow let's find out your Guarantor's data."
+
+            next_field_data = self._find_form_data(next_field)
+            bot_reply += f"\n\nNext question. {next_field_data.base_prompt}"
+
+        is_complete = True if session.current_field_index == len(self.flat_fields) else False
+
+        return bot_reply, is_complete
+
+    def _apply_skip_rules(self, session):
+        """
+        Fills the fields whose skip_if rule applies to the saved answers, e.g.
+        the status of residence of a Japanese guarantor, so they are not asked.
+
+        Args:
+            session (ChatSession): The session to fill.
+        """
+        for field in self.schema.skip_rules:
+            rule = field.skip_if
+            if self._saved_value(session, field.name) is None and \
+                    self._saved_value(session, rule["field"]) == rule["equals"]:
+                self._save_info(rule["value"], field.name, session)
+
+    def _saved_value(self, session, field_name):
+        """
+        Args:
+            session (ChatSession): The session to look in.
+            field_name (str): The dot-separated field name.
+
+        Returns:
+            The saved value of the field, or None if it has not been saved yet.
+        """
+        return self.schema.lookup(session.saved_info, self.schema[field_name])
+
+    def _extraction_request(self, session, user_input):
+        """
+        Builds a single model request that extracts all remaining fields of the
+        form from one free-text answer.
+
+        Args:
+            session (ChatSession): The session the input belongs to.
+            user_input (str): The user's input.
+
+        Returns:
+            tuple: (fields (list), response_model, messages (list))
+        """
+        fields = [field_name for field_name in self.flat_fields[session.current_field_index:]
+                  if self._saved_value(session, field_name) is None]
+
+        items = list()
+        model_fields = dict()
+        for field_name in fields:
+            field_data = self._find_form_data(field_name)
+            key = field_name.replace(".", "__")
+            items.append(f"- {key}: {field_data.description}\n  Validation rules: {field_data.validation_rule}")
+            model_fields[key] = (Optional[ChatInfo], Field(default=None, description=field_data.description))
+        response_model = create_model("FormExtraction", **model_fields)
+
+        items = "\n".join(items)
+        messages = [
+            {
+                "role" : "system",
+                "content" : f"""You are an expert at validating and extracting data.
+
+Follow these instructions:
+1. The user input describes several items of a form at once. For every item below that the user input mentions, return the extracted data in the 'field' of that item.
+2. Leave the items that the user input does not mention empty.
+3. If an extracted item is not valid, write a helpful message in its 'error_message', and set its is_valid to False.
+
+Items of the form:
+{items}"""
+            },
+            {
+                "role" : "user",
+                "content" : f"{user_input}"
+            }
+        ]
+
+        return fields, response_model, messages
+
+    def _apply_extraction(self, session, fields, extraction):
+        """
+        Saves every valid field of a multi-field extraction, and moves the session
+        to the first field that is still missing.
+
+        Args:
+            session (ChatSession): The session the input belongs to.
+            fields (list): The dot-separated names of the fields that were requested.
+            extraction: The response of the model from _extraction_request(), or
+                None if the model failed within the retry policy.
+
+        Returns:
+            tuple: (bot_reply (str), is_complete (bool))
+        """
+        if extraction is None:
+            field_data = self._find_form_data(self.flat_fields[session.current_field_index])
+            return f"That did not work out quite well for the following reason:\n{MODEL_FAILURE_MESSAGE}\n\nLets try again. {field_data.base_prompt}", False
+
+        saved = list()
+        problems = list()
+        for field_name in fields:
+            info = getattr(extraction, field_name.replace(".", "__"))
+            if info is None or not info.field:
+                continue
+
+            field_data = self._find_form_data(field_name)
+            if not info.is_valid:
+                problems.append(f"- {field_data.description.rstrip('.')}: "
+                                f"{info.error_message or INVALID_ANSWER_MESSAGE}")
+                continue
+
+            value, error_message = self._normalize_value(field_name, info.field)
+            if error_message is None:
+                self._save_info(value, field_name, session)
+                saved.append(f"- {field_data.description.rstrip('.')}: {value}")
+            else:
+                problems.append(f"- {field_data.description.rstrip('.')}: {error_message}")
+
+        self._apply_skip_rules(session)
+
+        session.current_field_index = next(
+            (index for index, field_name in enumerate(self.flat_fields)
+             if self._saved_value(session, field_name) is None),
+            len(self.flat_fields))
+
+        bot_reply = "Thank you!"
+        if saved:
+            bot_reply += " The following data has been saved:\n" + "\n".join(saved)
+        if problems:
+            bot_reply += "\n\nThese answers did not work out quite well:\n" + "\n".join(problems)
+
+        is_complete = session.current_field_index == len(self.flat_fields)
+        if not is_complete:
+            next_field_data = self._find_form_data(self.flat_fields[session.current_field_index])
+            bot_reply += f"\n\nNext question. {next_field_data.base_prompt}"
+
+        return bot_reply, is_complete
+
+    def get_fast_path_stats(self):
+        """
+        Reports how many turns were validated locally instead of by the model.
+
+        Returns:
+            dict: The number of fast path and model turns, and the model latency
+            saved by the fast path, estimated from the average model turn.
+        """
+        average_llm_seconds = self.llm_seconds / self.llm_turns if self.llm_turns else 0.0
+        return {
+            "fast_path_turns": self.fast_path_turns,
+            "llm_turns": self.llm_turns,
+            "average_llm_seconds": average_llm_seconds,
+            "estimated_seconds_saved": self.fast_path_turns * average_llm_seconds,
+        }
+
+    def get_retry_stats(self):
+        """
+        Reports the retries spent per field and the latency of model turns.
+
+        Returns:
+            dict: Retries per field, the number of turns where the model failed
+            within the retry policy, and the p50, p95 and maximum model turn latency.
+        """
+        latencies = sorted(self.turn_latencies)
+        percentile = lambda q: latencies[min(int(len(latencies) * q), len(latencies) - 1)] if latencies else 0.0
+        return {
+            "retries_per_field": dict(self.retries_per_field),
+            "failed_turns": self.failed_turns,
+            "turn_latency_p50": percentile(0.5),
+            "turn_latency_p95": percentile(0.95),
+            "turn_latency_max": latencies[-1] if latencies else 0.0,
+        }
+
+class ChatBot(_ChatBotBase):
+    """
+    A chatbot to help fill out a letter of guarantee form. 
+    Uses the Instructor API to validate and extract data from user input with a Llama 3.1-8b model.
+    It will ask questions one by one, validate the input, and save the data.
+    """
+    def __init__(self, local_validators=None, cache=None, base_url=OLLAMA_BASE_URL, schema=None,
+                 retry_policy=None, session_store=None):
+        """
+        Args:
+            local_validators (dict): Validators tried before the model, by name.
+                Defaults to LOCAL_VALIDATORS.
+            cache (ValidationCache): Cache of model responses. None disables caching.
+            base_url (str): The OpenAI compatible endpoint serving the model.
+            schema (FormSchema): The form to fill. Defaults to the letter of guarantee.
+            retry_policy (RetryPolicy): How model calls are retried. Defaults to
+                retrying model_name on schema errors within a latency budget.
+            session_store: A DictSessionStore or SQLiteSessionStore every saved
+                field is written to, so that sessions can be resumed. None keeps
+                sessions in memory only.
+        """
+        super().__init__(local_validators, cache, base_url, schema, retry_policy, session_store)
+        self.session = self._create_session()
+        self.stream_timings = list()
+
+    def _make_client(self, base_url):
+        """
+        Creates the instructor client used to talk to the model.
+
+        Args:
+            base_url (str): The OpenAI compatible endpoint serving the model.
+
+        Returns:
+            The instructor client.
+        """
+        import instructor
+        from openai import OpenAI # needed only for API conformity for instructor.
+
+        return instructor.from_openai(
+            OpenAI(
+                base_url=base_url,
+                api_key="ollama",  # required, but unused
+                max_retries=0,  # retries are handled by the RetryPolicy
+            ),
+            mode=instructor.Mode.JSON,
+        )
+
+    def warm_up(self, keep_alive="30m"):
+        """
+        Loads the slow imports, creates the client and asks Ollama to load the
+        model into memory on a background thread, so that the first answer
+        does not wait for them.
+
+        Args:
+            keep_alive (str): How long Ollama keeps the model loaded.
+
+        Returns:
+            threading.Thread: The warm-up thread.
+        """
+        thread = threading.Thread(target=self._warm_up, args=(keep_alive,), daemon=True)
+        thread.start()
+
+        return thread
+
+    def resume(self, session_id):
+        """
+        Continues a session saved in the session store, e.g. after a restart.
+        Fields validated before are not asked about or validated again.
+
+        Args:
+            session_id (str): The id of the session, see session_id.
+
+        Returns:
+            tuple: (bot_reply (str), is_complete (bool))
+
+        Raises:
+            KeyError: If the session is not in the store.
+        """
+        self.session = self._restore_session(session_id)
+        return self._resume_reply(self.session)
+
+    @property
+    def session_id(self):
+        return self.session.session_id
+
+    @property
+    def saved_info(self):
+        return self.session.saved_info
+
+    @saved_info.setter
+    def saved_info(self, value):
+        self.session.saved_info = value
+
+    @property
+    def current_field_index(self):
+        return self.session.current_field_index
+
+    @current_field_index.setter
+    def current_field_index(self, value):
+        self.session.current_field_index = value
+
     def start_conversation(self):
         """
-        Starts the conversation with the user by printing the initial greeting and the first question.
+        Starts the conversation with the user by printing the initial greeting and the first question,
+        while warming up the model in the background.
         """
+        self.warm_up()
         prompt = """Hello! I'm here to help you fill this form.
 
 Let's begin!"""
         form_field = self._find_form_data(self.flat_fields[self.current_field_index])
-        print(f"{prompt}\n\n{form_field['base_prompt']}")
+        print(f"{prompt}\n\n{form_field.base_prompt}")
+
+    def _validate_with_llm(self, field_data, user_input):
+        """
+        Asks the model to validate and extract the user's input for a field.
+
+        Args:
+            field_data (FormField): The compiled field.
+            user_input (str): The user's input.
+
+        Returns:
+            ChatInfo: The model's response.
+        """
+        response = self._create_with_retries(field_data.name, ChatInfo,
+                                             self._validation_messages(field_data, user_input))
+        if response is None:
+            return ChatInfo(field=user_input, is_valid=False, error_message=MODEL_FAILURE_MESSAGE)
+
+        return response
 
+    @instrumentation.timed("model_call")
+    def _create_with_retries(self, field_name, response_model, messages):
+        """
+        Calls the model following the retry policy.
+
+        Args:
+            field_name (str): The field the call is for, used for the retry statistics.
+            response_model: The pydantic model of the response.
+            messages (list): The chat messages.
+
+        Returns:
+            An instance of response_model, or None if no attempt succeeded within the policy.
+        """
+        from instructor.exceptions import InstructorRetryException
+        from openai import APITimeoutError
+
+        start = time.perf_counter()
+        attempts = 0
+        response = None
+        for model in self.retry_policy.attempts():
+            timeout = self._remaining_budget(start)
+            if timeout is not None and timeout <= 0:
+                break
+            attempts += 1
+            try:
+                response = self.instructor_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    max_retries=1,
+                    response_model=response_model,
+                    timeout=timeout
+                )
+                break
+            except (InstructorRetryException, ValidationError, APITimeoutError) as e:
+                error = _unwrap_model_error(e)
+                if isinstance(error, APITimeoutError):
+                    break
+                if not isinstance(error, (ValidationError, json.JSONDecodeError)):
+                    # The server could not be reached or rejected the request.
+                    raise error from e
+                # The output did not match the schema, so retry or escalate.
+                continue
+
+        self._record_attempts(field_name, max(attempts - 1, 0), response is None,
+                              time.perf_counter() - start)
+
+        return response
+
+    @instrumentation.timed("process_user_input")
     def process_user_input(self, user_input):
         """
         Processes the user's input for the current field, validates it, saves it if valid, and generates the next prompt.
@@ -187,73 +954,152 @@ Let's begin!"""
         # Validate the user input
         # If it is correct, save it and return is_completed=True with positive ack.
         # If not return False along with negative ack.
-        current_field = self.flat_fields[self.current_field_index]
-        field_data = self._find_form_data(current_field)
-        response = self.instructor_client.chat.completions.create(
-            model=self.model_name,
-            messages = [
-                {
-                    "role" : "system",
-                    "content" : f"""You are an expert at validating and extracting data.
+        local_value = self._validate_locally(self.session, user_input)
+        current_field, field_data, reply = self._begin_turn(self.session, local_value)
+        if reply is not None:
+            return reply
 
-Follow these instructions:
-1. Return only the extracted data in the 'field' of the response model. 
-2. If the user input is not valid, write a message in the 'error_message' of the response model, and set is_valid to False.
-3. The error message should be helpful, and assist the user in providing the proper input.
-
-Description of the user input: {field_data['description']}
-Validation rules of the user input: {field_data['validation_rule']}"""
-                },
-                {
-                    "role" : "user",
-                    "content" : f"{user_input}"
-                }
-            ],
-            max_retries=5,
-            response_model=ChatInfo
-        )
-        
-        if response.is_valid:
-            valid_response = response.field
-
-            if current_field == "date":
-                valid_response = dateparser.parse(valid_response).strftime("%Y-%m-%d")
-            elif "phone_number" in current_field:
-                parsed_number = phonenumbers.parse(valid_response, "JP")
-                if phonenumbers.is_valid_number(parsed_number):
-                    valid_response = f"+{parsed_number.country_code}-{parsed_number.national_number}"
-                else:
-                    response.is_valid = False
-                    response.error_message = f"The phone number provided {valid_response}, is not valid. Please provide a valid Japanese phone number."
-                    return f"That did not work out quite well for the following reason:\n{response.error_message}\n\nLets try again. {field_data['base_prompt']}", False
-
-            self._save_info(valid_response, current_field)
-
-            self.current_field_index += 1
-
-            bot_reply = f"Thank you! The data has been saved as {valid_response}."
-            if self.current_field_index < len(self.flat_fields):
-                # Skip the status of residence and period of stay if the guarantor is Japanese.
-                if current_field == "guarantor.nationality" and response.field == "Japan":
-                    self.current_field_index += 2
-                    self.saved_info["guarantor"]["status_of_residence"] = "NA"
-                    self.saved_info["guarantor"]["period_of_stay"] = "NA"
-
-                next_field = self.flat_fields[self.current_field_index]
-                if "guarantor" in next_field and "guarantor" not in current_field:
-                    bot_reply += "\n\nNow let's find out your Guarantor's data."
-
-                next_field_data = self._find_form_data(next_field)
-                bot_reply += f"\n\nNext question. {next_field_data['base_prompt']}"
+        cache_key, response = self._cached_response(field_data, user_input)
+        if response is None:
+            start = time.perf_counter()
+            response = self._validate_with_llm(field_data, user_input)
+            self._record_llm_response(cache_key, response, time.perf_counter() - start)
+
+        return self._finish_turn(self.session, current_field, field_data, response)
+
+    def is_complete(self):
+        """
+        Returns:
+            bool: Whether every field of the form has been filled.
+        """
+        return self.current_field_index == len(self.flat_fields)
+
+    def stream_user_input(self, user_input):
+        """
+        Streaming variant of process_user_input(). The reply is yielded in chunks
+        as the model generates it, instead of after the whole structured response.
+
+        The model is asked for 'field', 'is_valid' and 'error_message', but JSON
+        keys may arrive in any order, so 'field' is only known to be complete once
+        another key changes after it, or when the stream ends. A valid answer is
+        then saved and acknowledged without waiting for the rest of the response,
+        and the error message of an invalid answer is passed on while it is being
+        generated. Attempts follow the retry policy like process_user_input(), but
+        a stream is not retried once part of an error message was shown. Use
+        is_complete() afterwards to check whether the form is done.
+
+        The time to the first streamed token and to the accept or reject decision
+        are recorded per field in stream_timings.
+
+        Args:
+            user_input (str): The user's input.
+
+        Yields:
+            str: Consecutive chunks of the bot reply.
+        """
+        from instructor.exceptions import InstructorRetryException
+        from openai import APITimeoutError
+
+        local_value = self._validate_locally(self.session, user_input)
+        current_field, field_data, reply = self._begin_turn(self.session, local_value)
+        if reply is not None:
+            yield reply[0]
+            return
+
+        cache_key, response = self._cached_response(field_data, user_input)
+        if response is not None:
+            yield self._finish_turn(self.session, current_field, field_data, response)[0]
+            return
+
+        start = time.perf_counter()
+        timing = {"field": current_field, "time_to_first_token": None, "time_to_decision": None}
+        messages = self._validation_messages(field_data, user_input)
+        attempts = 0
+        error_shown = None
+        for model in self.retry_policy.attempts():
+            timeout = self._remaining_budget(start)
+            if timeout is not None and timeout <= 0:
+                break
+            attempts += 1
+            previous = None
+            field_closed = False
+            try:
+                for partial in self.instructor_client.chat.completions.create_partial(
+                    model=model,
+                    messages=messages,
+                    max_retries=1,
+                    response_model=ChatInfo,
+                    timeout=timeout
+                ):
+                    if timing["time_to_first_token"] is None:
+                        timing["time_to_first_token"] = time.perf_counter() - start
+                    if previous is not None and partial.field is not None and \
+                            partial.field == previous.field and \
+                            (partial.is_valid, partial.error_message) != (previous.is_valid, previous.error_message):
+                        field_closed = True
+                    previous = partial
+                    if partial.is_valid is False and partial.error_message:
+                        if error_shown is None:
+                            error_shown = ""
+                            yield "That did not work out quite well for the following reason:\n"
+                        yield partial.error_message[len(error_shown):]
+                        error_shown = partial.error_message
+                    if field_closed and partial.is_valid:
+                        # Nothing after 'field' and 'is_valid' matters for a valid answer.
+                        break
+            # The partial JSON parser raises a plain ValueError on malformed output.
+            except (InstructorRetryException, ValueError, APITimeoutError) as e:
+                error = _unwrap_model_error(e)
+                if isinstance(error, APITimeoutError) or error_shown is not None:
+                    break
+                if not isinstance(error, ValueError):
+                    # The server could not be reached or rejected the request.
+                    raise error from e
+                # The output did not match the schema, so retry or escalate.
+                continue
+            if previous is not None and previous.field is not None and previous.is_valid is not None:
+                response = ChatInfo(field=previous.field, is_valid=previous.is_valid,
+                                    error_message=None if previous.is_valid else previous.error_message)
+                timing["time_to_decision"] = time.perf_counter() - start
+                break
+            # The stream ended without a complete response, e.g. it was empty.
+            if error_shown is not None:
+                break
+
+        timing["total"] = time.perf_counter() - start
+        self.stream_timings.append(timing)
+        self._record_attempts(current_field, max(attempts - 1, 0), response is None, timing["total"])
+        if response is None:
+            # Only part of the response arrived, so it is not cached.
+            cache_key = None
+            response = ChatInfo(field=user_input, is_valid=False,
+                                error_message=error_shown or MODEL_FAILURE_MESSAGE)
+        self._record_llm_response(cache_key, response, timing["total"])
+
+        if error_shown is None:
+            yield self._finish_turn(self.session, current_field, field_data, response)[0]
         else:
-            bot_reply = f"""That did not work out quite well for the following reason:
-{response.error_message}
+            yield f"\n\nLets try again. {field_data.base_prompt}"
 
-Lets try again. {field_data['base_prompt']}"""
-        
-        is_complete = True if self.current_field_index == len(self.flat_fields) else False
+    @instrumentation.timed("extract_fields")
+    def extract_fields(self, user_input):
+        """
+        Fills as many of the remaining form fields as possible from one free-text
+        answer, such as the whole guarantor block, with a single model call.
+        Fields that are missing or invalid are asked about one by one afterwards.
 
-        return bot_reply, is_complete
+        Args:
+            user_input (str): The user's input.
+
+        Returns:
+            tuple: (bot_reply (str), is_complete (bool))
+        """
+        fields, response_model, messages = self._extraction_request(self.session, user_input)
+        start = time.perf_counter()
+        extraction = self._create_with_retries("extraction", response_model, messages)
+        self._record_llm_response(None, extraction, time.perf_counter() - start)
+
+        return self._apply_extraction(self.session, fields, extraction)
 
     def get_collected_data(self):
         """
@@ -264,21 +1110,259 @@ Lets try again. {field_data['base_prompt']}"""
         """
         return self.saved_info
 
-def letter_of_guarantee_chat():
+class AsyncChatBot(_ChatBotBase):
+    """
+    An asyncio counterpart of ChatBot that serves many concurrent sessions from
+    one process. Sessions are passed to every call instead of being kept on the
+    bot. All sessions share one pooled async client, the number of requests in
+    flight to the local model server is capped by a semaphore, and local
+    validation runs on a worker thread so that it never blocks the event loop.
+    """
+    def __init__(self, local_validators=None, cache=None, base_url=OLLAMA_BASE_URL, schema=None,
+                 retry_policy=None, session_store=None, max_concurrency=4):
+        """
+        Args:
+            local_validators (dict): Validators tried before the model, by name.
+                Defaults to LOCAL_VALIDATORS.
+            cache (ValidationCache): Cache of model responses. None disables caching.
+            base_url (str): The OpenAI compatible endpoint serving the model.
+            schema (FormSchema): The form to fill. Defaults to the letter of guarantee.
+            retry_policy (RetryPolicy): How model calls are retried.
+            session_store: The store sessions are persisted to, or None.
+            max_concurrency (int): The maximum number of concurrent model requests.
+        """
+        import asyncio
+
+        self.max_concurrency = max_concurrency
+        super().__init__(local_validators, cache, base_url, schema, retry_policy, session_store)
+        self._model_slots = asyncio.Semaphore(max_concurrency)
+
+    def _make_client(self, base_url):
+        import httpx
+        import instructor
+        from openai import AsyncOpenAI
+
+        return instructor.from_openai(
+            AsyncOpenAI(
+                base_url=base_url,
+                api_key="ollama",  # required, but unused
+                max_retries=0,  # retries are handled by the RetryPolicy
+                http_client=httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=self.max_concurrency,
+                                        max_keepalive_connections=self.max_concurrency),
+                    timeout=None,
+                ),
+            ),
+            mode=instructor.Mode.JSON,
+        )
+
+    async def warm_up(self, keep_alive="30m"):
+        """
+        Loads the slow imports, creates the client and asks Ollama to load the
+        model into memory on a worker thread. Schedule it with
+        asyncio.create_task() to warm up in the background.
+
+        Args:
+            keep_alive (str): How long Ollama keeps the model loaded.
+        """
+        import asyncio
+
+        await asyncio.to_thread(self._warm_up, keep_alive)
+
+    def new_session(self):
+        """
+        Starts a new applicant session.
+
+        Returns:
+            tuple: (session (ChatSession), greeting with the first question (str))
+        """
+        session = self._create_session()
+        form_field = self._find_form_data(self.flat_fields[session.current_field_index])
+
+        return session, f"Hello! I'm here to help you fill this form.\n\nLet's begin!\n\n{form_field.base_prompt}"
+
+    def resume(self, session_id):
+        """
+        Continues a session saved in the session store, e.g. after a restart.
+
+        Args:
+            session_id (str): The id of the session.
+
+        Returns:
+            tuple: (session (ChatSession), bot_reply (str))
+
+        Raises:
+            KeyError: If the session is not in the store.
+        """
+        session = self._restore_session(session_id)
+        return session, self._resume_reply(session)[0]
+
+    async def _validate_with_llm(self, field_data, user_input):
+        """
+        Asks the model to validate and extract the user's input for a field,
+        waiting for a free slot towards the model server first.
+
+        Returns:
+            ChatInfo: The model's response.
+        """
+        response = await self._create_with_retries(
+            field_data.name, ChatInfo, self._validation_messages(field_data, user_input))
+        if response is None:
+            return ChatInfo(field=user_input, is_valid=False, error_message=MODEL_FAILURE_MESSAGE)
+
+        return response
+
+    @instrumentation.timed("model_call")
+    async def _create_with_retries(self, field_name, response_model, messages):
+        """
+        Calls the model following the retry policy, waiting for a free slot
+        towards the model server for each attempt.
+
+        Returns:
+            An instance of response_model, or None if no attempt succeeded within the policy.
+        """
+        import asyncio
+        from instructor.exceptions import InstructorRetryException
+        from openai import APITimeoutError
+
+        start = time.perf_counter()
+        attempts = 0
+        response = None
+        for model in self.retry_policy.attempts():
+            timeout = self._remaining_budget(start)
+            if timeout is not None and timeout <= 0:
+                break
+            # Waiting for a slot counts against the turn's latency budget.
+            try:
+                await asyncio.wait_for(self._model_slots.acquire(), timeout)
+            except asyncio.TimeoutError:
+                break
+            try:
+                timeout = self._remaining_budget(start)
+                if timeout is not None and timeout <= 0:
+                    break
+                attempts += 1
+                response = await self.instructor_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    max_retries=1,
+                    response_model=response_model,
+                    timeout=timeout
+                )
+                break
+            except (InstructorRetryException, ValidationError, APITimeoutError) as e:
+                error = _unwrap_model_error(e)
+                if isinstance(error, APITimeoutError):
+                    break
+                if not isinstance(error, (ValidationError, json.JSONDecodeError)):
+                    # The server could not be reached or rejected the request.
+                    raise error from e
+                # The output did not match the schema, so retry or escalate.
+                continue
+            finally:
+                self._model_slots.release()
+
+        self._record_attempts(field_name, max(attempts - 1, 0), response is None,
+                              time.perf_counter() - start)
+
+        return response
+
+    @instrumentation.timed("process_user_input")
+    async def process_user_input(self, session, user_input):
+        """
+        Processes the user's input for the current field of a session.
+
+        Args:
+            session (ChatSession): The session the input belongs to.
+            user_input (str): The user's input.
+
+        Returns:
+            tuple: (bot_reply (str), is_complete (bool))
+        """
+        import asyncio
+
+        # The validators parse dates and phone numbers, and import their libraries on first use.
+        local_value = await asyncio.to_thread(self._validate_locally, session, user_input)
+        current_field, field_data, reply = self._begin_turn(session, local_value)
+        if reply is not None:
+            return reply
+
+        cache_key, response = self._cached_response(field_data, user_input)
+        if response is None:
+            start = time.perf_counter()
+            response = await self._validate_with_llm(field_data, user_input)
+            self._record_llm_response(cache_key, response, time.perf_counter() - start)
+
+        return self._finish_turn(session, current_field, field_data, response)
+
+    @instrumentation.timed("extract_fields")
+    async def extract_fields(self, session, user_input):
+        """
+        Fills as many of the remaining form fields of a session as possible from
+        one free-text answer with a single model call.
+
+        Args:
+            session (ChatSession): The session the input belongs to.
+            user_input (str): The user's input.
+
+        Returns:
+            tuple: (bot_reply (str), is_complete (bool))
+        """
+        fields, response_model, messages = self._extraction_request(session, user_input)
+        start = time.perf_counter()
+        extraction = await self._create_with_retries("extraction", response_model, messages)
+        self._record_llm_response(None, extraction, time.perf_counter() - start)
+
+        return self._apply_extraction(session, fields, extraction)
+
+def letter_of_guarantee_chat(multi_field=False, stream=False, session_store=None, session_id=None):
     """
     Runs the interactive chat session for filling out the letter of guarantee form.
 
+    Args:
+        multi_field (bool): If True, first ask for all the details in one message
+            and extract them together, then ask only about what is missing.
+        stream (bool): If True, print the bot replies while they are generated.
+        session_store: The store the session is persisted to, or None.
+        session_id (str): The id of a session in session_store to resume.
+
     Returns:
         dict: The final collected form data after completion.
     """
-    chatbot = ChatBot()
-    chatbot.start_conversation()
+    chatbot = ChatBot(cache=ValidationCache(), session_store=session_store)
 
     is_complete = False
+    if session_id is not None:
+        response, is_complete = chatbot.resume(session_id)
+        print("Bot:", response)
+    elif multi_field:
+        chatbot.warm_up()
+        print("Hello! I'm here to help you fill this form.\n\n"
+              "Please tell me everything you can about yourself and your guarantor in one message: "
+              "the date for the form, your full name and nationality, and your guarantor's name, "
+              "address and phone number in Japan, place of employment and its phone number, "
+              "nationality, status of residence, period of stay and relationship to you.")
+        response, is_complete = chatbot.extract_fields(input("You: "))
+        print("Bot:", response)
+    else:
+        chatbot.start_conversation()
+
+    id_shown = session_id is not None
     while not is_complete:
+        # The session can only be resumed once something was saved in it.
+        if not id_shown and chatbot.session_id is not None and chatbot.saved_info:
+            print(f"(Your session id is {chatbot.session_id}. Use it to continue later.)")
+            id_shown = True
         user_input = input("You: ")
-        response, is_complete = chatbot.process_user_input(user_input)
-        print("Bot:", response)
+        if stream:
+            print("Bot:", end=" ", flush=True)
+            for chunk in chatbot.stream_user_input(user_input):
+                print(chunk, end="", flush=True)
+            print()
+            is_complete = chatbot.is_complete()
+        else:
+            response, is_complete = chatbot.process_user_input(user_input)
+            print("Bot:", response)
 
     final_data = chatbot.get_collected_data()
 
@@ -0,0 +1,205 @@
+"""
+batch_writer.py
+
+Fills the letter of guarantee form for many pre-collected records at once.
+
+Each record has the same nested shape as ChatBot.get_collected_data(). Records
+are read from a JSONL file (one record per line) or a CSV file whose column
+names are the dot-separated field names, e.g. "guarantor.name".
+
+The blanks are detected once, and the overlays are rendered across a pool of
+worker processes that write the images straight to disk. Records are read
+lazily and only a bounded number of them are in flight at any time, so memory
+use does not grow with the size of the input. When stage recording is
+enabled, the workers send the stages they recorded back with each record.
+A record that fails to render is reported with its index, and the batch goes on.
+
+With --vector-pdf the records are instead stamped as text onto the original
+PDF page, and written as one page each into a single small PDF.
+
+Usage:
+    python batch_writer.py records.jsonl --out-dir filled --workers 4
+    python batch_writer.py records.jsonl --vector-pdf filled.pdf
+"""
+
+import argparse
+import csv
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import instrumentation
+from pdf_utils import download_letter_of_guarantee, render_pdf_page, find_form_blanks, \
+    DEFAULT_DPI
+from pdf_chat_writer import FormRenderer, PdfFormWriter
+
+# Per worker process renderer, set once by _init_worker().
+_worker_renderer = None
+
+def _nest_record(flat_record):
+    """
+    Converts a record with dot-separated keys into the nested shape returned
+    by ChatBot.get_collected_data().
+
+    Args:
+        flat_record (dict): A record such as {"guarantor.name": "..."}.
+
+    Returns:
+        dict: The nested record.
+    """
+    record = dict()
+    for field_name, value in flat_record.items():
+        keys = field_name.split(".")
+        store = record
+        for k in keys[:-1]:
+            store = store.setdefault(k, dict())
+        store[keys[-1]] = value
+
+    return record
+
+def read_records(path):
+    """
+    Lazily reads form records from a JSONL or CSV file.
+
+    Args:
+        path (str): The path to a .jsonl or .csv file.
+
+    Yields:
+        dict: One nested form record at a time.
+    """
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            for row in csv.DictReader(f):
+                yield _nest_record(row)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def _init_worker(page, form_rectangles):
+    """
+    Creates the FormRenderer holding the form page and its blanks in the worker process.
+    """
+    global _worker_renderer
+    _worker_renderer = FormRenderer(page, form_rectangles)
+    if instrumentation.recorder is not None:
+        # A forked worker inherits the stages the parent recorded so far.
+        instrumentation.recorder.take_records()
+
+def _fill_record(index, record, out_dir):
+    """
+    Renders one record onto a copy of the form page and writes it to disk.
+
+    Args:
+        index (int): The position of the record in the input.
+        record (dict): The nested form record.
+        out_dir (str): The output directory.
+
+    Returns:
+        tuple: (index (int), output path (str) or None if the record failed,
+        seconds spent (float), error (str) or None, the stages recorded for
+        the record (list))
+    """
+    start = time.perf_counter()
+    out_path = os.path.join(out_dir, f"overlay_{index:06d}.png")
+    error = None
+    try:
+        _worker_renderer.save(record, out_path).result()
+    except Exception as e:
+        # Sent as text, since not every exception can be pickled back to the parent.
+        out_path, error = None, f"{type(e).__name__}: {e}"
+    seconds = time.perf_counter() - start
+    stage_records = [] if instrumentation.recorder is None else instrumentation.recorder.take_records()
+
+    return index, out_path, seconds, error, stage_records
+
+def _collect(future):
+    """
+    Waits for a record and adds the stages its worker recorded to the recorder of this process.
+
+    Returns:
+        tuple: (index (int), output path (str) or None, seconds spent (float), error (str) or None)
+    """
+    index, out_path, seconds, error, stage_records = future.result()
+    if instrumentation.recorder is not None:
+        instrumentation.recorder.add_records(stage_records)
+
+    return index, out_path, seconds, error
+
+def fill_records(records, page, form_rectangles, out_dir, workers=None, max_in_flight=None):
+    """
+    Fills the form for every record using a process pool.
+
+    Args:
+        records: An iterable of nested form records.
+        page: The grayscale form page.
+        form_rectangles: The rectangles returned by find_form_blanks().
+        out_dir (str): The directory the filled forms are written to.
+        workers (int): The number of worker processes. Defaults to the CPU count.
+        max_in_flight (int): The maximum number of records submitted but not
+            yet finished. Defaults to four per worker.
+
+    Yields:
+        tuple: (index (int), output path (str), seconds spent (float), error (str) or None)
+        per record, in input order. A record that failed has no output path and
+        the error it failed with; the other records are still filled.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers * 4
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(page, form_rectangles)) as pool:
+        pending = deque()
+        for index, record in enumerate(records):
+            if len(pending) >= max_in_flight:
+                yield _collect(pending.popleft())
+            pending.append(pool.submit(_fill_record, index, record, out_dir))
+
+        while pending:
+            yield _collect(pending.popleft())
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the letter of guarantee for many records.")
+    parser.add_argument("records", help="A .jsonl or .csv file of form records.")
+    parser.add_argument("--pdf", default="letter_of_guarantee.pdf", help="The form PDF.")
+    parser.add_argument("--out-dir", default="filled", help="Where to write the filled forms.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes.")
+    parser.add_argument("--dpi", type=int, default=DEFAULT_DPI, help="Resolution of the form page.")
+    parser.add_argument("--vector-pdf", default=None,
+                        help="Write all forms as text on the original PDF page into this file.")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.pdf):
+        download_letter_of_guarantee(args.pdf)
+    page = render_pdf_page(args.pdf, dpi=args.dpi)
+    form_rectangles = find_form_blanks(page, False)
+
+    start = time.perf_counter()
+    if args.vector_pdf:
+        writer = PdfFormWriter(args.pdf, page.shape, form_rectangles)
+        count = writer.write(read_records(args.records), args.vector_pdf)
+        elapsed = time.perf_counter() - start
+        print(f"Filled {count} forms into {args.vector_pdf} in {elapsed:.2f} s.")
+        return
+
+    count = 0
+    failed = list()
+    for index, out_path, seconds, error in fill_records(read_records(args.records), page,
+                                                        form_rectangles, args.out_dir, args.workers):
+        if error is not None:
+            failed.append(index)
+            print(f"record {index}: failed: {error}")
+            continue
+        count += 1
+        print(f"record {index}: {out_path} in {seconds * 1000:.1f} ms")
+
+    elapsed = time.perf_counter() - start
+    if count:
+        print(f"Filled {count} forms in {elapsed:.2f} s ({count / elapsed:.1f} forms/s).")
+    if failed:
+        print(f"{len(failed)} records failed: {', '.join(map(str, failed))}")
+
+if __name__ == "__main__":
+    main()
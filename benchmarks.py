@@ -0,0 +1,437 @@
+"""
+benchmarks.py
+
+Benchmarks for the form processing pipeline, from rendering the PDF and
+detecting the blanks to the chat turns and writing the filled forms.
+
+Pages are synthetic letter sized pages at several resolutions, and the chat
+runs against the stub model server of load_test.py, so everything runs
+offline. bench_pipeline() also shows the per-stage JSON report of the
+instrumentation hooks.
+
+Run all benchmarks with `python benchmarks.py`, or some of them with e.g.
+`python benchmarks.py chat pipeline`.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+from PIL import Image
+from pdf2image.exceptions import PDFInfoNotInstalledError
+import instrumentation
+from pdf_utils import BLANK_TEMPLATES, _combine_rectangles, _combine_rectangles_vectorized, \
+    _find_rectangles_for_blanks, _find_rectangles_for_templates, _load_template, \
+    render_pdf_page, convert_pdf_to_png, find_form_blanks
+from pdf_chat_writer import _solve_font_scale, _write_image, FormRenderer, PdfFormWriter
+from form_schema import load_form_schema
+from ai_chat import ChatBot, ChatSession
+from load_test import SAMPLE_ANSWERS, start_stub_server
+
+def _timeit(func, *args, repeat=3):
+    """
+    Run a function several times and return the best wall time.
+
+    Args:
+        func: The function to time.
+        *args: Arguments passed to the function.
+        repeat: The number of runs.
+    Returns:
+        tuple: (best time in seconds, result of the last run)
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+def synthetic_match_map(dpi, seed=0):
+    """
+    Build a boolean map that looks like the thresholded matchTemplate() output
+    of a letter sized page: horizontal runs of matches with small gaps.
+
+    Args:
+        dpi: The resolution of the page.
+        seed: The random seed.
+    Returns:
+        A 2D boolean numpy array.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = int(11 * dpi), int(8.5 * dpi)
+    match_map = np.zeros((height, width), dtype=bool)
+    for y in rng.integers(0, height, size=dpi // 2):
+        x0 = rng.integers(0, width // 2)
+        x1 = rng.integers(x0, width)
+        match_map[y:y + dpi // 30, x0:x1] = rng.random(x1 - x0) < 0.9
+
+    return match_map
+
+def synthetic_page(dpi, seed=0):
+    """
+    Build a grayscale letter sized page with rows of dotted blanks stamped
+    from the blank templates, plus some noise standing in for printed text.
+
+    Args:
+        dpi: The resolution of the page.
+        seed: The random seed.
+    Returns:
+        A 2D uint8 numpy array.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = int(11 * dpi), int(8.5 * dpi)
+    page = np.full((height, width), 255, dtype=np.uint8)
+    for x, y in rng.integers(0, (width - 200, height - 40), size=(dpi, 2)):
+        cv2.putText(page, "Text", (int(x), int(y) + 30), cv2.FONT_HERSHEY_SIMPLEX, 1, 0, 2)
+
+    for i, (template_path, _, _, _) in enumerate(BLANK_TEMPLATES):
+        template = cv2.imread(template_path, cv2.IMREAD_GRAYSCALE)
+        th, tw = template.shape
+        for y in range(200 + i * 60, height - 200, 300):
+            x0 = int(rng.integers(0, width // 2))
+            for x in range(x0, min(x0 + tw * 15, width - tw), tw):
+                np.minimum(page[y:y + th, x:x + tw], template, out=page[y:y + th, x:x + tw])
+
+    return page
+
+def bench_combine_rectangles(dpis=(100, 200, 300)):
+    """
+    Compare the loop based and vectorized rectangle merging on synthetic match
+    maps, checking that both return the same rectangles.
+    """
+    for dpi in dpis:
+        loc = np.where(synthetic_match_map(dpi))
+        loop_time, expected = _timeit(_combine_rectangles, loc, 40)
+        vec_time, combined = _timeit(_combine_rectangles_vectorized, loc, 40)
+        assert [tuple(map(int, rect)) for rect in expected] == combined
+        print(f"combine_rectangles dpi={dpi} points={len(loc[0])}: "
+              f"loop {loop_time * 1000:.1f} ms, vectorized {vec_time * 1000:.1f} ms, "
+              f"speedup {loop_time / vec_time:.1f}x")
+
+def bench_pyramid_matching(dpis=(100, 200, 300), levels=(1, 2)):
+    """
+    Compare exhaustive template matching against coarse-to-fine matching on
+    synthetic pages, checking that both find the same rectangles.
+    """
+    for dpi in dpis:
+        page = synthetic_page(dpi)
+        for template_path, threshold, x_adjust, y_adjust in BLANK_TEMPLATES:
+            template = cv2.imread(template_path, cv2.IMREAD_GRAYSCALE)
+            full_time, expected = _timeit(_find_rectangles_for_blanks, page, template,
+                                          threshold, x_adjust, y_adjust)
+            for level in levels:
+                pyr_time, found = _timeit(_find_rectangles_for_blanks, page, template,
+                                          threshold, x_adjust, y_adjust, True, level)
+                print(f"pyramid dpi={dpi} template={template_path} levels={level}: "
+                      f"exhaustive {full_time * 1000:.1f} ms, pyramid {pyr_time * 1000:.1f} ms, "
+                      f"speedup {full_time / pyr_time:.1f}x, same={found == expected}")
+
+def bench_multi_template(dpis=(100, 200, 300), pyramid_levels=2):
+    """
+    Compare matching each blank template separately in pyramid mode against
+    _find_rectangles_for_templates(), which builds the page pyramid once for
+    all templates. Each template still needs its own matchTemplate() passes.
+    """
+    templates = [(_load_template(template_path), threshold, x_adjust, y_adjust)
+                 for template_path, threshold, x_adjust, y_adjust in BLANK_TEMPLATES]
+
+    def separate(page):
+        combined = []
+        for template, threshold, x_adjust, y_adjust in templates:
+            combined += _find_rectangles_for_blanks(page, template, threshold, x_adjust,
+                                                    y_adjust, True, pyramid_levels)
+        return combined
+
+    for dpi in dpis:
+        page = synthetic_page(dpi)
+        separate_time, expected = _timeit(separate, page)
+        multi_time, found = _timeit(_find_rectangles_for_templates, page, templates, True,
+                                    pyramid_levels)
+        print(f"multi_template dpi={dpi} templates={len(templates)}: "
+              f"separate {separate_time * 1000:.1f} ms, shared pyramid {multi_time * 1000:.1f} ms, "
+              f"same={found == expected}")
+
+def _fit_text_stepping(text, rect_width, font=cv2.FONT_HERSHEY_SIMPLEX, thickness=1):
+    """
+    The original fit_text_to_rectangle() search, stepping the scale down by 0.01.
+    """
+    font_scale = 1.0
+    (text_w, _), _ = cv2.getTextSize(text, font, font_scale, thickness)
+    while rect_width < text_w:
+        font_scale -= 0.01
+        (text_w, _), _ = cv2.getTextSize(text, font, font_scale, thickness)
+
+    return font_scale
+
+def bench_fit_text(records=1000):
+    """
+    Compare stepping the font scale down against the binary search of
+    fit_text_to_rectangle(), with and without its cache, over form fields of
+    varying length. Drawing the text is not included.
+    """
+    rng = np.random.default_rng(0)
+    fields = [("1-2-3 Example-cho, Chiyoda-ku, Tokyo 100-0001 " * 2)[:int(n)]
+              for n in rng.integers(5, 90, size=records)]
+    widths = [int(w) for w in rng.integers(150, 900, size=records)]
+    font = cv2.FONT_HERSHEY_SIMPLEX
+
+    def stepping():
+        return [_fit_text_stepping(text, width) for text, width in zip(fields, widths)]
+
+    def solved():
+        return [_solve_font_scale(text, font, 1, width, 41) for text, width in zip(fields, widths)]
+
+    def uncached():
+        _solve_font_scale.cache_clear()
+        return solved()
+
+    stepping_time, expected = _timeit(stepping)
+    uncached_time, found = _timeit(uncached)
+    cached_time, _ = _timeit(solved)
+    same = all(abs(a - b) < 1e-6 for a, b in zip(expected, found))
+    print(f"fit_text fields={records}: stepping {stepping_time * 1000:.1f} ms, "
+          f"binary search {uncached_time * 1000:.1f} ms, cached {cached_time * 1000:.1f} ms, "
+          f"same={same}")
+
+def synthetic_record(schema, seed=0):
+    """
+    Build a nested form record with a value of varying length for every field.
+
+    Args:
+        schema: The FormSchema to build the record for.
+        seed: The random seed.
+    Returns:
+        dict: The nested form record.
+    """
+    rng = np.random.default_rng(seed)
+    record = dict()
+    for field in schema.fields:
+        store = record
+        for k in field.path[:-1]:
+            store = store.setdefault(k, dict())
+        store[field.path[-1]] = ("1-2-3 Example-cho, Chiyoda-ku, Tokyo 100-0001 " * 2)[:int(rng.integers(5, 60))]
+
+    return record
+
+def bench_pdf_output(records=50, dpi=200):
+    """
+    Compare rendering filled forms to PNG files against stamping them as text
+    onto the vector PDF page with PdfFormWriter, in time and bytes per form.
+    The base PDF is the synthetic page saved as a single page PDF.
+    """
+    schema = load_form_schema()
+    page = synthetic_page(dpi)
+    form_rectangles = [(200 + i * 150, 100, 40, 800) for i in range(len(schema))]
+    forms = [synthetic_record(schema, seed) for seed in range(records)]
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        pdf_path = os.path.join(out_dir, "form.pdf")
+        Image.fromarray(page).save(pdf_path, "PDF", resolution=dpi)
+
+        def png():
+            with FormRenderer(page, form_rectangles) as renderer:
+                for i, form in enumerate(forms):
+                    renderer.save(form, os.path.join(out_dir, f"form_{i}.png"))
+            return sum(os.path.getsize(os.path.join(out_dir, f"form_{i}.png"))
+                       for i in range(records))
+
+        def vector():
+            writer = PdfFormWriter(pdf_path, page.shape, form_rectangles)
+            writer.write(forms, os.path.join(out_dir, "forms.pdf"))
+            return os.path.getsize(os.path.join(out_dir, "forms.pdf"))
+
+        png_time, png_bytes = _timeit(png)
+        vector_time, vector_bytes = _timeit(vector)
+        base_bytes = os.path.getsize(pdf_path)
+
+    print(f"pdf_output forms={records} dpi={dpi}: "
+          f"png {png_time / records * 1000:.1f} ms and {png_bytes / records / 1024:.1f} KB per form, "
+          f"vector pdf {vector_time / records * 1000:.2f} ms and "
+          f"{(vector_bytes - base_bytes) / records / 1024:.1f} KB per form over the base page, "
+          f"speedup {png_time / vector_time:.1f}x")
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+def bench_render_pdf(dpis=(100, 200, 300)):
+    """
+    Time rasterizing a single page PDF in memory with render_pdf_page() and
+    through a PNG file with convert_pdf_to_png(). Needs poppler.
+    """
+    with tempfile.TemporaryDirectory() as out_dir:
+        pdf_path = os.path.join(out_dir, "form.pdf")
+        Image.fromarray(synthetic_page(200)).save(pdf_path, "PDF", resolution=200)
+        for dpi in dpis:
+            try:
+                render_time, _ = _timeit(render_pdf_page, pdf_path, 1, dpi)
+            except PDFInfoNotInstalledError:
+                print("render_pdf skipped, poppler is not installed")
+                return
+            png_time, _ = _timeit(convert_pdf_to_png, pdf_path, os.path.join(out_dir, "form.png"), dpi)
+            print(f"render_pdf dpi={dpi}: in memory {render_time * 1000:.1f} ms, "
+                  f"via png {png_time * 1000:.1f} ms")
+
+def bench_find_form_blanks(dpis=(100, 200, 300)):
+    """
+    Split find_form_blanks() into matchTemplate() and merging the matches,
+    and compare a full detection against a layout cache hit.
+    """
+    for dpi in dpis:
+        page = synthetic_page(dpi)
+        match_time = combine_time = 0.0
+        for template_path, threshold, _, _ in BLANK_TEMPLATES:
+            template = _load_template(template_path)
+            seconds, res = _timeit(cv2.matchTemplate, page, template, cv2.TM_CCOEFF_NORMED)
+            match_time += seconds
+            loc = np.where(res >= threshold)
+            seconds, _ = _timeit(_combine_rectangles_vectorized, loc, template.shape[0])
+            combine_time += seconds
+
+        full_time, _ = _timeit(find_form_blanks, page, False, None)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            find_form_blanks(page, False, cache_dir)
+            cached_time, _ = _timeit(find_form_blanks, page, False, cache_dir)
+        print(f"find_form_blanks dpi={dpi}: matchTemplate {match_time * 1000:.1f} ms, "
+              f"combine {combine_time * 1000:.1f} ms, total {full_time * 1000:.1f} ms, "
+              f"cached {cached_time * 1000:.2f} ms")
+
+def bench_write_image(dpis=(100, 200, 300), records=10):
+    """
+    Time encoding and writing a filled form as PNG and as a raster PDF.
+    """
+    with tempfile.TemporaryDirectory() as out_dir:
+        for dpi in dpis:
+            page = synthetic_page(dpi)
+            timings = dict()
+            for ext in ("png", "pdf"):
+                out_path = os.path.join(out_dir, f"form.{ext}")
+                seconds, _ = _timeit(lambda: [_write_image(page, out_path) for _ in range(records)])
+                timings[ext] = (seconds / records, os.path.getsize(out_path))
+            print(f"write_image dpi={dpi}: " + ", ".join(
+                f"{ext} {seconds * 1000:.1f} ms {size / 1024:.0f} KB"
+                for ext, (seconds, size) in timings.items()))
+
+def bench_chat(sessions=20, delay=0.02):
+    """
+    Drive whole forms through ChatBot.process_user_input() against the stub
+    model server, with and without the local validators.
+    """
+    server, base_url = start_stub_server(delay)
+    try:
+        for local in (False, True):
+            chatbot = ChatBot(local_validators=None if local else {}, base_url=base_url)
+            latencies = []
+            start = time.perf_counter()
+            for _ in range(sessions):
+                chatbot.session = ChatSession()
+                is_complete = False
+                while not is_complete:
+                    answer = SAMPLE_ANSWERS[chatbot.current_field_index]
+                    turn_start = time.perf_counter()
+                    _, is_complete = chatbot.process_user_input(answer)
+                    latencies.append(time.perf_counter() - turn_start)
+            elapsed = time.perf_counter() - start
+            print(f"chat sessions={sessions} model_delay={delay * 1000:.0f} ms "
+                  f"local_validators={local}: {elapsed / sessions * 1000:.0f} ms per form, "
+                  f"turn p50 {_percentile(latencies, 0.5) * 1000:.1f} ms, "
+                  f"p95 {_percentile(latencies, 0.95) * 1000:.1f} ms")
+    finally:
+        server.shutdown()
+
+def bench_pipeline(records=200, dpi=200):
+    """
+    Run detection and many filled forms end to end with the instrumentation
+    hooks enabled, and print their per-stage JSON report.
+    """
+    schema = load_form_schema()
+    page = synthetic_page(dpi)
+    forms = [synthetic_record(schema, seed) for seed in range(records)]
+    recorder = instrumentation.enable()
+    try:
+        with tempfile.TemporaryDirectory() as out_dir:
+            form_rectangles = find_form_blanks(page, False, None)
+            form_rectangles = (form_rectangles * len(schema))[:len(schema)]
+            with FormRenderer(page, form_rectangles) as renderer:
+                for i, form in enumerate(forms):
+                    renderer.save(form, os.path.join(out_dir, f"form_{i}.png"))
+    finally:
+        instrumentation.disable()
+
+    print(f"pipeline forms={records} dpi={dpi}:")
+    print(json.dumps(recorder.summary(), indent=2))
+
+# Slow to import dependencies each module only loads on the paths needing them.
+DEFERRED_IMPORTS = {
+    "ai_chat": ("dateparser", "phonenumbers", "instructor", "openai", "httpx"),
+    "pdf_utils": ("pdf2image", "requests"),
+    "pdf_chat_writer": ("dateparser", "phonenumbers", "instructor", "openai", "httpx", "pdf2image",
+                        "requests"),
+}
+
+def _import_seconds(statement, repeat=3):
+    """
+    Run a statement in a fresh interpreter with -X importtime and sum the
+    cumulative time of its top level imports, less the interpreter's own.
+
+    Returns:
+        float: The best import time in seconds.
+    """
+    def run(statement):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+                                capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        total = 0
+        for line in result.stderr.splitlines():
+            parts = line.split("|")
+            # Top level imports are indented by a single space.
+            if len(parts) == 3 and parts[1].strip().isdigit() and not parts[2].startswith("  "):
+                total += int(parts[1])
+        return total / 1e6
+
+    return min(run(statement) - run("pass") for _ in range(repeat))
+
+def bench_import_time():
+    """
+    Compare the import time of the pipeline modules with the time it takes
+    when the dependencies they load lazily are imported eagerly as well, as
+    they were before, and check that none of them is loaded at import.
+    """
+    for module, deferred in DEFERRED_IMPORTS.items():
+        lazy = _import_seconds(f"import {module}")
+        eager = _import_seconds(f"import {module}, {', '.join(deferred)}")
+        loaded = subprocess.run(
+            [sys.executable, "-c", f"import sys, {module}; "
+                                   f"print([m for m in {deferred!r} if m in sys.modules])"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        print(f"import {module}: {lazy * 1000:.0f} ms, with the deferred dependencies "
+              f"{eager * 1000:.0f} ms, speedup {eager / lazy:.1f}x, deferred loaded at import {loaded}")
+
+BENCHMARKS = {
+    "combine_rectangles": bench_combine_rectangles,
+    "pyramid_matching": bench_pyramid_matching,
+    "multi_template": bench_multi_template,
+    "fit_text": bench_fit_text,
+    "pdf_output": bench_pdf_output,
+    "render_pdf": bench_render_pdf,
+    "find_form_blanks": bench_find_form_blanks,
+    "write_image": bench_write_image,
+    "chat": bench_chat,
+    "pipeline": bench_pipeline,
+    "import_time": bench_import_time,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the form processing pipeline.")
+    parser.add_argument("benchmarks", nargs="*", choices=[[]] + list(BENCHMARKS),
+                        help="The benchmarks to run. Defaults to all of them.")
+    args = parser.parse_args()
+    for name in args.benchmarks or BENCHMARKS:
+        BENCHMARKS[name]()
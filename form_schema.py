@@ -0,0 +1,158 @@
+"""
+form_schema.py
+
+Compiled form definitions.
+
+A form is defined as a nested dictionary of fields, usually loaded from a JSON
+or YAML file such as letter_of_guarantee.json. Each field has a base_prompt,
+description and validation_rule, and optionally the name of a local validator
+and the index of the rectangle on the form image it is written into. Fields
+with a small set of common answers, such as nationalities, are marked
+"cacheable": true, so that the model's responses for them may be cached. A field
+may also have a skip_if rule such as
+{"field": "guarantor.nationality", "equals": "Japan", "value": "NA"}, which
+fills it with value instead of asking once the other field has that answer.
+Fields with "nested": true group further fields under a dot-separated prefix.
+
+FormSchema compiles such a definition once into a flat index of fields with
+precomputed key paths and prompts, so that nothing has to be split or
+formatted again per turn, and one schema can be shared by every session.
+"""
+
+import functools
+import json
+import os
+
+# The form definition used by default.
+LETTER_OF_GUARANTEE_FORM = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        "letter_of_guarantee.json")
+
+# System prompt used to validate a single field.
+VALIDATION_PROMPT = """You are an expert at validating and extracting data.
+
+Follow these instructions:
+1. Return only the extracted data in the 'field' of the response model.
+2. If the user input is not valid, write a message in the 'error_message' of the response model, and set is_valid to False.
+3. The error message should be helpful, and assist the user in providing the proper input.
+
+Description of the user input: {description}
+Validation rules of the user input: {validation_rule}"""
+
+class FormField:
+    """
+    A single compiled form field.
+    """
+    __slots__ = ("name", "path", "base_prompt", "description", "validation_rule",
+                 "local_validator", "rectangle", "skip_if", "cacheable", "system_prompt")
+
+    def __init__(self, name, field_dict):
+        """
+        Args:
+            name (str): The dot-separated field name.
+            field_dict (dict): The field definition.
+        """
+        self.name = name
+        self.path = tuple(name.split("."))
+        self.base_prompt = field_dict["base_prompt"]
+        self.description = field_dict["description"]
+        self.validation_rule = field_dict["validation_rule"]
+        self.local_validator = field_dict.get("local_validator")
+        self.rectangle = field_dict.get("rectangle")
+        self.skip_if = field_dict.get("skip_if")
+        self.cacheable = bool(field_dict.get("cacheable", False))
+        self.system_prompt = VALIDATION_PROMPT.format(description=self.description,
+                                                      validation_rule=self.validation_rule)
+
+class FormSchema:
+    """
+    A compiled form definition, shared by all sessions filling the same form.
+    """
+    __slots__ = ("form_data", "fields", "flat_fields", "skip_rules", "_by_name")
+
+    def __init__(self, form_data):
+        """
+        Args:
+            form_data (dict): The nested form definition.
+        """
+        self.form_data = form_data
+        self.fields = tuple(FormField(name, field_dict)
+                            for name, field_dict in self._flatten("", form_data))
+        self.flat_fields = [field.name for field in self.fields]
+        self._by_name = {field.name: field for field in self.fields}
+        self.skip_rules = tuple(field for field in self.fields if field.skip_if)
+        for field in self.skip_rules:
+            if field.skip_if["field"] not in self._by_name:
+                raise ValueError(f"The skip_if rule of {field.name} refers to the unknown "
+                                 f"field {field.skip_if['field']}.")
+
+    @classmethod
+    def _flatten(cls, prefix, form_dict):
+        """
+        Recursively flattens the form fields, including nested fields.
+
+        Args:
+            prefix (str): The prefix for nested fields.
+            form_dict (dict): The dictionary representing the form structure.
+
+        Yields:
+            tuple: (dot-separated field name (str), field definition (dict))
+        """
+        for k, v in form_dict.items():
+            if isinstance(v, dict) and v.get("nested"):
+                yield from cls._flatten(f"{prefix}{k}.", v)
+            elif k != "nested":
+                yield prefix + k, v
+
+    def __getitem__(self, name):
+        """
+        Args:
+            name (str): The dot-separated field name.
+
+        Returns:
+            FormField: The compiled field.
+        """
+        return self._by_name[name]
+
+    def __len__(self):
+        return len(self.fields)
+
+    @staticmethod
+    def lookup(data, field):
+        """
+        Looks up the value of a field in a nested dictionary of form data, such
+        as the one returned by ChatBot.get_collected_data().
+
+        Args:
+            data (dict): The nested form data.
+            field (FormField): The field to look up.
+
+        Returns:
+            The value, or None if the field is not present.
+        """
+        for k in field.path:
+            if not isinstance(data, dict) or k not in data:
+                return None
+            data = data[k]
+
+        return data
+
+@functools.lru_cache(maxsize=None)
+def load_form_schema(path=LETTER_OF_GUARANTEE_FORM):
+    """
+    Loads and compiles a form definition from a JSON or YAML file. Schemas are
+    cached, so every caller gets the same shared instance per file.
+
+    Args:
+        path (str): The path to a .json, .yaml or .yml file.
+
+    Returns:
+        FormSchema: The compiled form.
+    """
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+            form_data = yaml.safe_load(f)
+        else:
+            form_data = json.load(f)
+
+    return FormSchema(form_data)
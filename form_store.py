@@ -0,0 +1,240 @@
+"""
+form_store.py
+
+A local artifact store for the source form PDFs.
+
+Downloaded files are stored under the SHA-256 of their content, and an index
+maps each URL to the hash, ETag and Last-Modified date of its current copy.
+A verified copy is used without touching the network until it is older than
+the refresh interval, after which it is revalidated with a conditional
+request, so the form is only downloaded again when the server has a new
+version. In offline mode the network is never used.
+
+start_form_server() serves a file over HTTP locally, standing in for the
+real server in tests.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Default location of the store.
+FORM_STORE_DIR = ".form_store"
+
+# Headers sent with every request. The MOJ server rejects the default
+# User-Agent of requests.
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36"
+}
+
+def _sha256(path):
+    """
+    Returns:
+        str: The hex SHA-256 of the file's content.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def _write_atomic(path, data):
+    """
+    Writes a file so that readers never see it partially written.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+class FormStore:
+    """
+    Content addressed store of downloaded forms with conditional refresh.
+    """
+    def __init__(self, root=FORM_STORE_DIR, session=None, timeout=30.0, offline=False,
+                 refresh_interval_seconds=7 * 24 * 3600):
+        """
+        Args:
+            root (str): The directory the store is kept in.
+            session (requests.Session): The session used for downloads. A new
+                one is created by default, and reused for every request.
+            timeout (float): The timeout of each request in seconds.
+            offline (bool): Never use the network, only verified local copies.
+            refresh_interval_seconds (float): How long a copy is used before it
+                is revalidated with the server. 0 revalidates on every fetch.
+        """
+        self.root = root
+        self.timeout = timeout
+        self.offline = offline
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.session = session
+        self.requests_made = 0
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        self._index_path = os.path.join(root, "index.json")
+        try:
+            with open(self._index_path) as f:
+                self._index = json.load(f)
+        except (OSError, ValueError):
+            self._index = dict()
+
+    def _object_path(self, sha256):
+        return os.path.join(self.root, "objects", sha256)
+
+    def _verified_path(self, url):
+        """
+        Returns:
+            str: The path of the stored copy of url if its content matches
+            its hash, otherwise None.
+        """
+        entry = self._index.get(url)
+        if entry is None:
+            return None
+
+        path = self._object_path(entry["sha256"])
+        if not os.path.exists(path) or _sha256(path) != entry["sha256"]:
+            return None
+
+        return path
+
+    def _save_index(self):
+        _write_atomic(self._index_path, json.dumps(self._index, indent=2).encode())
+
+    def fetch(self, url):
+        """
+        Returns a verified local copy of url, downloading it only when there
+        is no copy yet, or when the server has a newer version than a copy
+        older than the refresh interval.
+
+        Args:
+            url (str): The URL of the form.
+
+        Returns:
+            str: The path of the verified copy in the store.
+
+        Raises:
+            FileNotFoundError: In offline mode, if there is no verified copy.
+            requests.RequestException: If the download fails and there is no
+                verified copy to fall back to.
+        """
+        path = self._verified_path(url)
+        entry = self._index.get(url)
+        if path is not None and (self.offline or
+                                 time.time() - entry["checked_at"] < self.refresh_interval_seconds):
+            return path
+        if self.offline:
+            raise FileNotFoundError(f"No verified copy of {url} in {self.root} and the store is offline.")
+
+        # Only imported when the network is used, which it is not in steady state.
+        import requests
+
+        headers = dict(DEFAULT_HEADERS)
+        if path is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        if self.session is None:
+            self.session = requests.Session()
+        try:
+            self.requests_made += 1
+            r = self.session.get(url, headers=headers, timeout=self.timeout)
+            if not (r.status_code == 304 and path is not None):
+                r.raise_for_status()
+        except requests.RequestException as e:
+            if path is None:
+                raise
+            print(f"Could not revalidate {url}, using the stored copy: {e}")
+            return path
+
+        if r.status_code == 304:
+            entry["checked_at"] = time.time()
+        else:
+            sha256 = hashlib.sha256(r.content).hexdigest()
+            path = self._object_path(sha256)
+            _write_atomic(path, r.content)
+            self._index[url] = {
+                "sha256": sha256,
+                "etag": r.headers.get("ETag"),
+                "last_modified": r.headers.get("Last-Modified"),
+                "checked_at": time.time(),
+            }
+        self._save_index()
+
+        return path
+
+    def export(self, url, out_path):
+        """
+        Makes out_path a copy of the verified form, rewriting it only if its
+        content differs.
+
+        Args:
+            url (str): The URL of the form.
+            out_path (str): Where the form is needed.
+
+        Returns:
+            str: out_path
+        """
+        path = self.fetch(url)
+        sha256 = os.path.basename(path)
+        if not os.path.exists(out_path) or _sha256(out_path) != sha256:
+            with open(path, "rb") as f:
+                _write_atomic(out_path, f.read())
+
+        return out_path
+
+class _FormHandler(BaseHTTPRequestHandler):
+    """
+    Serves one file for every GET, with an ETag and Last-Modified date, and
+    answers conditional requests for an unchanged file with 304.
+    """
+    content = b""
+    modified = 0.0
+    requests_served = None
+
+    def do_GET(self):
+        self.requests_served.append(self.headers.get("If-None-Match"))
+        etag = f'"{hashlib.sha256(self.content).hexdigest()[:16]}"'
+        last_modified = formatdate(self.modified, usegmt=True)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(len(self.content)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+        self.wfile.write(self.content)
+
+    def log_message(self, *args):
+        pass
+
+def start_form_server(content):
+    """
+    Starts a local HTTP server serving content on a free port in a background
+    thread. Assign server.RequestHandlerClass.content to publish a new version.
+
+    Args:
+        content (bytes): The file to serve.
+
+    Returns:
+        tuple: (server, url (str), requests_served (list)), where requests_served
+        records the If-None-Match header of every request received.
+    """
+    requests_served = []
+    handler = type("FormHandler", (_FormHandler,), {"content": content, "modified": time.time(),
+                                                    "requests_served": requests_served})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_address[1]}/form.pdf", requests_served
@@ -0,0 +1,257 @@
+"""
+instrumentation.py
+
+Opt-in per-stage latency and memory recording for the form pipeline.
+
+The pipeline wraps its stages (rendering the page, detecting blanks, model
+turns, drawing and writing forms) in stage() or decorates them with timed(). While recording is disabled,
+which is the default, stage() does nothing. Once enabled, either with
+enable() or by setting the FORM_PIPELINE_METRICS environment variable to the
+path of a JSON file, every stage records its wall time, the peak Python memory
+it allocated (traced with tracemalloc) and the process' peak RSS, and a
+summary per stage is emitted as JSON.
+
+Usage:
+    FORM_PIPELINE_METRICS=metrics.json python batch_writer.py records.jsonl
+"""
+
+import atexit
+import contextlib
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+# Environment variable holding the path the metrics are written to at exit.
+METRICS_ENV = "FORM_PIPELINE_METRICS"
+
+def _max_rss_bytes():
+    """
+    Returns:
+        int: The peak RSS of the process in bytes, or None where the resource
+        module does not exist, i.e. on Windows.
+    """
+    # Only imported while recording, so that the pipeline imports on Windows.
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and in kilobytes on Linux.
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+class StageRecorder:
+    """
+    Records the latency and memory of named pipeline stages. Stages may be
+    nested. The traced memory peak is process wide, so the peaks of stages
+    running concurrently on several threads or coroutines are approximate.
+    """
+    def __init__(self, trace_memory=True, callback=None):
+        """
+        Args:
+            trace_memory (bool): Trace Python allocations with tracemalloc, which
+                slows allocation heavy code down.
+            callback: Called with the record dict of every finished stage, e.g.
+                to forward it to a metrics system.
+        """
+        self.trace_memory = trace_memory
+        self.callback = callback
+        self.records = list()
+        self._local = threading.local()
+        self._started_tracing = trace_memory and not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+
+    @property
+    def _peaks(self):
+        """
+        The running peak traced memory of each open stage of this thread, innermost last.
+        """
+        if not hasattr(self._local, "peaks"):
+            self._local.peaks = list()
+        return self._local.peaks
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Times the body of the with statement as one run of a stage.
+
+        Args:
+            name (str): The stage name.
+        """
+        if self.trace_memory:
+            start_memory = tracemalloc.get_traced_memory()[0]
+            self._close_peak()
+            self._peaks.append(start_memory)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            record = {
+                "stage": name,
+                "seconds": seconds,
+                "max_rss_bytes": _max_rss_bytes(),
+            }
+            if self.trace_memory:
+                self._close_peak()
+                peak = self._peaks.pop()
+                record["peak_memory_bytes"] = max(peak - start_memory, 0)
+                # The outer stage's peak includes the peak of this stage.
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+            self.records.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+    def take_records(self):
+        """
+        Removes and returns the records collected so far, e.g. to send them
+        from a worker process to the parent.
+
+        Returns:
+            list: The record dicts.
+        """
+        records, self.records = self.records, list()
+        return records
+
+    def add_records(self, records):
+        """
+        Adds records collected by another recorder, e.g. in a worker process.
+
+        Args:
+            records (list): Record dicts as returned by take_records().
+        """
+        for record in records:
+            self.records.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+    def _close_peak(self):
+        """
+        Folds the traced peak since the last reset into the innermost open
+        stage, so that nested stages can each reset the peak.
+        """
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+
+    def close(self):
+        """
+        Stops tracing memory if this recorder started it.
+        """
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def summary(self):
+        """
+        Returns:
+            dict: Per stage, the number of runs, the total, p50, p95 and maximum
+            seconds, and the largest peak memory and RSS seen.
+        """
+        stages = dict()
+        for record in self.records:
+            stages.setdefault(record["stage"], []).append(record)
+
+        summary = dict()
+        for name, records in stages.items():
+            seconds = sorted(record["seconds"] for record in records)
+            summary[name] = {
+                "count": len(seconds),
+                "total_seconds": sum(seconds),
+                "p50_seconds": seconds[len(seconds) // 2],
+                "p95_seconds": seconds[min(int(len(seconds) * 0.95), len(seconds) - 1)],
+                "max_seconds": seconds[-1],
+                "max_rss_bytes": max((record["max_rss_bytes"] for record in records
+                                      if record["max_rss_bytes"] is not None), default=None),
+            }
+            if self.trace_memory:
+                summary[name]["peak_memory_bytes"] = max(record["peak_memory_bytes"]
+                                                         for record in records)
+
+        return summary
+
+    def emit(self, path=None):
+        """
+        Writes the summary as JSON.
+
+        Args:
+            path (str): The output file. Defaults to stdout.
+        """
+        data = json.dumps(self.summary(), indent=2)
+        if path is None:
+            print(data, file=sys.stdout)
+        else:
+            with open(path, "w") as f:
+                f.write(data)
+
+# The active recorder, or None while recording is disabled.
+recorder = None
+
+def enable(trace_memory=True, callback=None):
+    """
+    Starts recording stages process wide.
+
+    Returns:
+        StageRecorder: The active recorder.
+    """
+    global recorder
+    recorder = StageRecorder(trace_memory, callback)
+    return recorder
+
+def disable():
+    """
+    Stops recording stages.
+
+    Returns:
+        StageRecorder: The recorder that was active, or None.
+    """
+    global recorder
+    previous, recorder = recorder, None
+    if previous is not None:
+        previous.close()
+    return previous
+
+def stage(name):
+    """
+    Records the body of the with statement as a stage if recording is enabled.
+
+    Args:
+        name (str): The stage name.
+    """
+    if recorder is None:
+        return contextlib.nullcontext()
+
+    return recorder.stage(name)
+
+def timed(name):
+    """
+    Decorator recording every call of a function as a stage. For a coroutine
+    function the stage covers the whole awaited call.
+
+    Args:
+        name (str): The stage name.
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+if os.environ.get(METRICS_ENV):
+    atexit.register(enable().emit, os.environ[METRICS_ENV])
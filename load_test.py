@@ -0,0 +1,137 @@
+"""
+load_test.py
+
+Load test for AsyncChatBot against a local stub OpenAI compatible server.
+
+The stub answers every chat completion after a fixed delay with a valid
+ChatInfo that echoes the user's message, standing in for Ollama. Many
+applicant sessions are then driven through the whole form concurrently.
+
+Usage:
+    python load_test.py --sessions 200 --max-concurrency 8 --delay 0.05
+"""
+
+import argparse
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ai_chat import AsyncChatBot
+
+# Answers given by every simulated applicant, in the order they are asked.
+SAMPLE_ANSWERS = [
+    "2024-05-01",
+    "Taro Yamada",
+    "Nepali",
+    "Hanako Suzuki",
+    "100-0001, Tokyo, Chiyoda-ku, Example Building 3F",
+    "03-1234-5678",
+    "Example Corporation",
+    "03-8765-4321",
+    "Vietnamese",
+    "Permanent Resident",
+    "2020-04-01 to 2027-03-31",
+    "Friend",
+]
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers /v1/chat/completions with a valid ChatInfo echoing the user message.
+    """
+    delay = 0.0
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        time.sleep(self.delay)
+        user_message = request["messages"][-1]["content"]
+        content = json.dumps({"field": user_message, "is_valid": True, "error_message": None})
+        body = json.dumps({
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }).encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_stub_server(delay):
+    """
+    Starts the stub server on a free local port in a background thread.
+
+    Args:
+        delay (float): Seconds to wait before answering each request.
+
+    Returns:
+        tuple: (server, base_url (str))
+    """
+    handler = type("StubHandler", (_StubHandler,), {"delay": delay})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+async def run_session(chatbot):
+    """
+    Drives one simulated applicant through the whole form.
+
+    Returns:
+        list: The latency of every turn in seconds.
+    """
+    session, _ = chatbot.new_session()
+    latencies = []
+    is_complete = False
+    while not is_complete:
+        answer = SAMPLE_ANSWERS[session.current_field_index]
+        start = time.perf_counter()
+        _, is_complete = await chatbot.process_user_input(session, answer)
+        latencies.append(time.perf_counter() - start)
+
+    return latencies
+
+async def run_load_test(base_url, sessions, max_concurrency, use_local_validators):
+    chatbot = AsyncChatBot(local_validators=None if use_local_validators else {},
+                           base_url=base_url, max_concurrency=max_concurrency)
+    start = time.perf_counter()
+    results = await asyncio.gather(*(run_session(chatbot) for _ in range(sessions)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for result in results for latency in result)
+    print(f"{sessions} sessions, {len(latencies)} turns in {elapsed:.2f} s "
+          f"({sessions / elapsed:.1f} forms/s, {len(latencies) / elapsed:.1f} turns/s)")
+    print(f"turn latency p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
+    print(chatbot.get_fast_path_stats())
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test AsyncChatBot against a stub model server.")
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--delay", type=float, default=0.05, help="Stub model latency in seconds.")
+    parser.add_argument("--no-local-validators", action="store_true",
+                        help="Send every turn to the model.")
+    args = parser.parse_args()
+
+    server, base_url = start_stub_server(args.delay)
+    try:
+        asyncio.run(run_load_test(base_url, args.sessions, args.max_concurrency,
+                                  not args.no_local_validators))
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
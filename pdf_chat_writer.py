@@ -4,7 +4,7 @@ pdf_chat_writer.py
 This script automates the process of filling out a letter of guarantee PDF form using conversational AI.
 It performs the following steps:
 1. Downloads the letter of guarantee PDF.
-2. Converts the PDF to a PNG image.
+2. Renders the form page to a grayscale image in memory.
 3. Detects blank fields in the form image.
 4. Interacts with the user via a chatbot to collect required form data.
 5. Overlays the collected data onto the detected blank fields in the form image.
@@ -16,14 +16,76 @@ Dependencies:
 """
 
 from pdf_utils import download_letter_of_guarantee, \
-    convert_pdf_to_png, find_form_blanks
+    render_pdf_page, find_form_blanks, DEFAULT_DPI
 from ai_chat import letter_of_guarantee_chat
+from form_schema import load_form_schema
+import instrumentation
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
 import cv2
+from PIL import Image
+
+# Smallest font scale fit_text_to_rectangle() will shrink text to.
+MIN_FONT_SCALE = 0.1
+
+# Largest font size, in points, PdfFormWriter writes text with.
+MAX_PDF_FONT_SIZE = 14.0
+
+# Every glyph of the standard Courier font is 0.6 em wide, so the width of a
+# string is known without loading font metrics.
+COURIER_GLYPH_WIDTH = 0.6
+
+# Height of Courier text from the descender to the cap height, in em.
+COURIER_TEXT_HEIGHT = 0.75
+
+def _fits(text, font, font_scale, thickness, rect_width, rect_height):
+    """
+    Returns:
+        bool: Whether the text at this font scale fits in the rectangle.
+    """
+    (text_w, text_h), baseline = cv2.getTextSize(text, font, font_scale, thickness)
+    return text_w <= rect_width and text_h + baseline <= rect_height
+
+@functools.lru_cache(maxsize=4096)
+def _solve_font_scale(text, font, thickness, rect_width, rect_height):
+    """
+    Find the largest font scale up to 1.0, in steps of 0.01, at which the text
+    fits in the rectangle.
+
+    The text size grows monotonically with the font scale, so a binary search
+    over the 0.01 steps needs at most 7 calls to cv2.getTextSize() instead of
+    up to 90 when stepping down one by one.
+
+    Args:
+        text: Text string to draw
+        font: OpenCV font type
+        thickness: Text thickness
+        rect_width, rect_height: Dimensions of rectangle
+
+    Returns:
+        The font scale, never below MIN_FONT_SCALE.
+    """
+    if _fits(text, font, 1.0, thickness, rect_width, rect_height):
+        return 1.0
+
+    lo, hi = round(MIN_FONT_SCALE * 100), 99
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if _fits(text, font, mid / 100, thickness, rect_width, rect_height):
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo / 100
 
 def fit_text_to_rectangle(image, text, rect_x, rect_y, rect_width, rect_height, 
                          font=cv2.FONT_HERSHEY_SIMPLEX, thickness=1):
     """
     Scale text to fit within a given rectangle and draw it on the image.
+
+    The font scale is solved by _solve_font_scale() and cached per text and
+    rectangle size, since the same values are drawn on every form.
     
     Args:
         image: Input image (numpy array)
@@ -38,57 +100,290 @@ def fit_text_to_rectangle(image, text, rect_x, rect_y, rect_width, rect_height,
         Final font scale used
     """
     
-    # Start with a reasonable font scale
-    font_scale = 1.0
-    
-    # Get text size with current scale
-    (text_w, _), _ = cv2.getTextSize(text, font, font_scale, thickness)
-
-    while rect_width < text_w:
-        font_scale -= 0.01
-        (text_w, _), _ = cv2.getTextSize(text, font, font_scale, thickness)
+    font_scale = _solve_font_scale(text, font, thickness, rect_width, rect_height)
     
     cv2.putText(image, text, (rect_x, rect_y), 
                 font, font_scale, (0,0,0), 2)
     
     return image, font_scale
 
-if __name__ == "__main__":
-    pdf_file = "letter_of_guarantee.pdf"
-    png_file = "letter_of_guarantee.png"
-    download_letter_of_guarantee(pdf_file)
-    convert_pdf_to_png(pdf_file, png_file)
-    form_rectangles = find_form_blanks(png_file, False)
-    user_form_fields = letter_of_guarantee_chat()
+@instrumentation.timed("overlay_form_data")
+def overlay_form_data(img, form_rectangles, user_form_fields, schema=None):
+    """
+    Draw the collected form data into the detected blanks of the form image.
+
+    Args:
+        img: The grayscale form image. It is drawn on in place.
+        form_rectangles: The rectangles returned by find_form_blanks().
+        user_form_fields: The nested dictionary returned by ChatBot.get_collected_data().
+        schema: The FormSchema binding fields to rectangles. Defaults to the letter of guarantee.
 
-    form_fields_order = [
-        "full_name", # 0
-        "guarantor.address_in_japan", # 1
-        "guarantor.guarantor_phone_number", # 2
-        "guarantor.place_of_employment", # 3
-        "guarantor.occupation_phone_number", # 4
-        "guarantor.nationality", # 5
-        "guarantor.status_of_residence", # 6
-        "guarantor.guarantor_relationship", # 7
-        "date", # 8
-        "nationality", # 9
-        "guarantor.name", # 10
-        "guarantor.signature" # 11
-    ]
-
-    img = cv2.imread(png_file, cv2.IMREAD_GRAYSCALE)
-    for rectangle_index, field in enumerate(form_fields_order):
-        if "signature" in field:
+    Returns:
+        The image with the form data drawn on it.
+    """
+    schema = load_form_schema() if schema is None else schema
+    for field in schema.fields:
+        if field.rectangle is None:
             continue
-        keys = field.split(".")
-        rectangle = form_fields_order[rectangle_index]
-        user_data = user_form_fields
 
-        for k in keys:
-            user_data = user_data[k]
+        user_data = schema.lookup(user_form_fields, field)
+        if not user_data:
+            # Missing fields are left blank, as in PdfFormWriter.
+            continue
 
-        pt = form_rectangles[rectangle_index]
+        pt = form_rectangles[field.rectangle]
 
         img, _ = fit_text_to_rectangle(img, user_data, pt[1], pt[0], pt[3], pt[2])
 
-    cv2.imwrite(f"overlay.png", img)
\ No newline at end of file
+    return img
+
+@instrumentation.timed("write_image")
+def _write_image(img, out_path):
+    """
+    Encode and write a rendered form. Paths ending in .pdf are written as a
+    single page PDF, anything else with cv2.imwrite().
+
+    Args:
+        img: The rendered form image.
+        out_path: The output path.
+    """
+    if out_path.lower().endswith(".pdf"):
+        Image.fromarray(img).save(out_path, "PDF", resolution=DEFAULT_DPI)
+    else:
+        cv2.imwrite(out_path, img)
+
+class FormRenderer:
+    """
+    Renders form data onto a blank form page that is decoded only once.
+
+    The renderer keeps the base page and the detected blanks in memory and
+    draws each record onto a copy of the base buffer. Encoding and writing the
+    output happens on background threads, so rendering the next record
+    overlaps with writing the previous one.
+    """
+    def __init__(self, page, form_rectangles, encode_threads=1, max_pending=8):
+        """
+        Args:
+            page: The grayscale blank form page.
+            form_rectangles: The rectangles returned by find_form_blanks().
+            encode_threads (int): The number of threads encoding output files.
+            max_pending (int): The maximum number of rendered forms waiting to
+                be written, which bounds memory use when encoding is slower
+                than rendering.
+        """
+        self.page = page
+        self.form_rectangles = form_rectangles
+        self._executor = ThreadPoolExecutor(max_workers=encode_threads)
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def render(self, user_form_fields):
+        """
+        Draws one record onto a copy of the base page.
+
+        Args:
+            user_form_fields (dict): The nested dictionary returned by ChatBot.get_collected_data().
+
+        Returns:
+            The rendered form image.
+        """
+        return overlay_form_data(self.page.copy(), self.form_rectangles, user_form_fields)
+
+    def save(self, user_form_fields, out_path):
+        """
+        Renders one record and writes it to disk in the background.
+
+        Args:
+            user_form_fields (dict): The nested dictionary returned by ChatBot.get_collected_data().
+            out_path (str): The output path, a PNG or PDF file.
+
+        Returns:
+            Future: Completes when the file has been written.
+        """
+        img = self.render(user_form_fields)
+        self._pending.acquire()
+        future = self._executor.submit(_write_image, img, out_path)
+        future.add_done_callback(lambda _: self._pending.release())
+
+        return future
+
+    def close(self):
+        """
+        Waits until all pending files are written.
+        """
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _pdf_font_size(text, rect_width, rect_height):
+    """
+    Find the largest Courier font size up to MAX_PDF_FONT_SIZE at which the
+    text fits in the rectangle.
+
+    Args:
+        text: Text string to write
+        rect_width, rect_height: Dimensions of rectangle in points
+
+    Returns:
+        The font size in points.
+    """
+    return min(MAX_PDF_FONT_SIZE,
+               rect_width / (COURIER_GLYPH_WIDTH * max(len(text), 1)),
+               rect_height / COURIER_TEXT_HEIGHT)
+
+def _pdf_string(text):
+    """
+    Returns:
+        bytes: The text as a PDF literal string in the Courier font's encoding.
+    """
+    data = text.encode("cp1252", errors="replace")
+    return b"(" + data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+class PdfFormWriter:
+    """
+    Writes form data as text onto the original vector PDF page instead of a
+    rasterized image.
+
+    The rectangles detected on the rendered page are mapped back to PDF
+    coordinates, and each record is stamped as a small content stream drawn
+    over the unchanged base page. All records written to one file share the
+    base page's content and resource objects, so every extra form only adds
+    its overlay stream, a few hundred bytes.
+
+    Only unrotated pages are supported.
+    """
+    FONT_NAME = "/FormWriterCourier"
+
+    def __init__(self, pdf_path, page_shape, form_rectangles, page=1, schema=None):
+        """
+        Args:
+            pdf_path (str): The blank form PDF.
+            page_shape (tuple): The shape of the rendered page the rectangles were
+                detected on, e.g. render_pdf_page(pdf_path).shape.
+            form_rectangles: The rectangles returned by find_form_blanks().
+            page (int): The 1-based page number of the form.
+            schema: The FormSchema binding fields to rectangles. Defaults to the letter of guarantee.
+        """
+        from pypdf import PdfReader
+
+        self.base_page = PdfReader(pdf_path).pages[page - 1]
+        self.form_rectangles = form_rectangles
+        self.schema = load_form_schema() if schema is None else schema
+
+        box = self.base_page.mediabox
+        height_px, width_px = page_shape[:2]
+        self.scale_x = float(box.width) / width_px
+        self.scale_y = float(box.height) / height_px
+        self.left = float(box.left)
+        self.top = float(box.top)
+
+    def overlay(self, user_form_fields):
+        """
+        Builds the content stream that writes one record onto the page.
+
+        Args:
+            user_form_fields (dict): The nested dictionary returned by ChatBot.get_collected_data().
+
+        Returns:
+            bytes: The content stream.
+        """
+        operations = [b"q 0 g"]
+        for field in self.schema.fields:
+            if field.rectangle is None:
+                continue
+
+            user_data = self.schema.lookup(user_form_fields, field)
+            if not user_data:
+                continue
+
+            pt = self.form_rectangles[field.rectangle]
+            # Like cv2.putText() the text's baseline is at the rectangle's
+            # top edge; PDF y-coordinates increase upwards.
+            x = self.left + pt[1] * self.scale_x
+            y = self.top - pt[0] * self.scale_y
+            font_size = _pdf_font_size(user_data, pt[3] * self.scale_x, pt[2] * self.scale_y)
+            operations.append(f"BT {self.FONT_NAME} {font_size:.2f} Tf {x:.2f} {y:.2f} Td ".encode()
+                              + _pdf_string(user_data) + b" Tj ET")
+        operations.append(b"Q")
+
+        return b"\n".join(operations)
+
+    @instrumentation.timed("write_vector_pdf")
+    def write(self, records, out_path):
+        """
+        Writes one page per record into a single PDF.
+
+        Args:
+            records: An iterable of nested form records.
+            out_path (str): The output PDF path.
+
+        Returns:
+            int: The number of forms written.
+        """
+        from pypdf import PdfWriter
+        from pypdf.generic import ArrayObject, DecodedStreamObject, DictionaryObject, NameObject
+
+        def add_stream(data):
+            stream = DecodedStreamObject()
+            stream.set_data(data)
+            return writer._add_object(stream)
+
+        writer = PdfWriter()
+        template = writer.add_page(self.base_page)
+
+        # Isolate the graphics state of the base page from the overlay.
+        contents = template.raw_get("/Contents") if "/Contents" in template else ArrayObject()
+        if not isinstance(contents, ArrayObject):
+            contents = ArrayObject([contents])
+        contents = ArrayObject([add_stream(b"q"), *contents, add_stream(b"Q")])
+
+        resources = DictionaryObject(template["/Resources"]) if "/Resources" in template \
+            else DictionaryObject()
+        fonts = DictionaryObject(resources["/Font"]) if "/Font" in resources else DictionaryObject()
+        fonts[NameObject(self.FONT_NAME)] = writer._add_object(DictionaryObject({
+            NameObject("/Type"): NameObject("/Font"),
+            NameObject("/Subtype"): NameObject("/Type1"),
+            NameObject("/BaseFont"): NameObject("/Courier"),
+            NameObject("/Encoding"): NameObject("/WinAnsiEncoding"),
+        }))
+        resources[NameObject("/Font")] = fonts
+        resources = writer._add_object(resources)
+
+        count = 0
+        for record in records:
+            page = template if count == 0 else \
+                writer.add_blank_page(template.mediabox.width, template.mediabox.height)
+            page[NameObject("/MediaBox")] = template.mediabox
+            page[NameObject("/Resources")] = resources
+            page[NameObject("/Contents")] = ArrayObject([*contents, add_stream(self.overlay(record))])
+            count += 1
+
+        if count == 0:
+            writer.remove_page(template)
+
+        writer.write(out_path)
+
+        return count
+
+    def save(self, user_form_fields, out_path):
+        """
+        Writes a single filled form.
+
+        Args:
+            user_form_fields (dict): The nested dictionary returned by ChatBot.get_collected_data().
+            out_path (str): The output PDF path.
+        """
+        self.write([user_form_fields], out_path)
+
+if __name__ == "__main__":
+    pdf_file = "letter_of_guarantee.pdf"
+    download_letter_of_guarantee(pdf_file)
+    page = render_pdf_page(pdf_file)
+    form_rectangles = find_form_blanks(page, False)
+    user_form_fields = letter_of_guarantee_chat()
+
+    with FormRenderer(page, form_rectangles) as renderer:
+        renderer.save(user_form_fields, "overlay.png")
\ No newline at end of file
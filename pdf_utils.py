@@ -1,24 +1,74 @@
-import requests
+import functools
+import hashlib
+import json
+import os
 import cv2
 import numpy as np
-from pdf2image import convert_from_path
-
-def download_letter_of_guarantee(f_name):
-    custom_headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36"
-    }
-    pr_form_url = "https://www.moj.go.jp/isa/content/930002537.pdf"
-    r = requests.get(pr_form_url, headers=custom_headers)
-
-    if r.status_code == 200:
-        with open(f_name, "wb") as f:
-            f.write(r.content)
-    else:
-        print(f"Failed to download the letter of guarantee. Status code: {r.status_code}")
+from form_store import FormStore
+import instrumentation
+
+# Where the letter of guarantee form is published.
+LETTER_OF_GUARANTEE_URL = "https://www.moj.go.jp/isa/content/930002537.pdf"
+
+# Templates of the dotted blanks on the form, as tuples of
+# (template path, threshold, x_adjust, y_adjust).
+BLANK_TEMPLATES = [
+    ("dots.png", 0.9, 20, 20),
+    ("dots2.png", 0.9, 15, 15),
+]
+
+# Resolution used to rasterize the form. This is the pdf2image default, which
+# the blank templates were cut from.
+DEFAULT_DPI = 200
+
+# Directory where detected blank layouts are stored, keyed by form fingerprint.
+LAYOUT_CACHE_DIR = ".layout_cache"
+
+# Bumped whenever the detection output changes, to invalidate cached layouts.
+_LAYOUT_CACHE_VERSION = 3
+
+# Hit/miss counters for the layout cache.
+layout_cache_stats = {"hits": 0, "misses": 0}
+
+@instrumentation.timed("download_form")
+def download_letter_of_guarantee(f_name, store=None):
+    """
+    Make f_name a verified copy of the letter of guarantee. The form is kept
+    in a FormStore and only downloaded again when the server has a new version.
+
+    Args:
+        f_name: Where to write the form PDF.
+        store: The FormStore to use. Defaults to one in FORM_STORE_DIR.
+    Returns:
+        The path f_name.
+    """
+    store = FormStore() if store is None else store
+    return store.export(LETTER_OF_GUARANTEE_URL, f_name)
 
+@instrumentation.timed("render_pdf_page")
+def render_pdf_page(pdf_path, page=1, dpi=DEFAULT_DPI):
+    """
+    Rasterize a single page of a PDF to a grayscale image in memory.
+
+    Args:
+        pdf_path: The path to the PDF.
+        page: The 1-based page number to render.
+        dpi: The resolution to render at.
+    Returns:
+        The page as a 2D uint8 numpy array.
+    """
+    from pdf2image import convert_from_path
+
+    images = convert_from_path(pdf_path, dpi=dpi, first_page=page, last_page=page,
+                               grayscale=True)
+
+    return np.asarray(images[0])
 
-def convert_pdf_to_png(pdf_path, png_path):
-    images = convert_from_path(pdf_path)
+@instrumentation.timed("convert_pdf_to_png")
+def convert_pdf_to_png(pdf_path, png_path, dpi=DEFAULT_DPI):
+    from pdf2image import convert_from_path
+
+    images = convert_from_path(pdf_path, dpi=dpi, first_page=1, last_page=1)
     images[0].save(f"{png_path}", "PNG")
 
 def _combine_rectangles(loc, h):
@@ -63,7 +113,126 @@ def _combine_rectangles(loc, h):
     # Return a list with tuples (x, y, w, h) for each combined rectangle.
     return combined
 
-def _find_rectangles_for_blanks(img, template, threshold, x_adjust, y_adjust):
+def _combine_rectangles_vectorized(loc, h):
+    """
+    Array based version of _combine_rectangles() that returns the same
+    rectangles without iterating over every matched point in Python.
+
+    A point closes the current rectangle when it starts a new row or is more
+    than 8 pixels to the right of the previous point. The closing point itself
+    is skipped and the point after it starts the next rectangle, so within a
+    run of consecutive closing points only every other one takes effect.
+    Args:
+        loc: The locations of the rectangles as a tuple of two arrays (y-coordinates, x-coordinates).
+        h: The height of the rectangles.
+    Returns:
+        A list of tuples (y, x, h, w) for each combined rectangle found.
+    """
+    ys = np.asarray(loc[0], dtype=np.int64)
+    xs = np.asarray(loc[1], dtype=np.int64)
+    n = len(ys)
+    if n == 0:
+        return []
+
+    new_row = np.zeros(n, dtype=bool)
+    new_row[1:] = ys[1:] != ys[:-1]
+    breaks = new_row.copy()
+    breaks[1:] |= np.diff(xs) > 8
+
+    # Keep the closing points at even offsets within each run of breaks.
+    idx = np.arange(n)
+    run_starts = breaks.copy()
+    run_starts[1:] &= ~breaks[:-1]
+    run_start_idx = np.maximum.accumulate(np.where(run_starts, idx, 0))
+    closing = np.flatnonzero(breaks & ((idx - run_start_idx) % 2 == 0))
+
+    starts = np.concatenate(([0], closing + 1))
+    closed_starts = starts[:len(closing)]
+    widths = 8 + xs[closing - 1] - xs[closed_starts] + np.where(new_row[closing], 20, 0)
+    combined = list(zip(ys[closed_starts].tolist(), xs[closed_starts].tolist(),
+                        [h] * len(closing), widths.tolist()))
+
+    last_start = starts[-1]
+    if last_start < n:
+        last_width = 8 + xs[n - 1] - xs[last_start] + 20
+    else:
+        # The last point closed a rectangle, which is emitted again with the
+        # trailing padding, exactly like the loop based version does.
+        last_start = closed_starts[-1]
+        last_width = 8 + xs[n - 2] - xs[last_start] + 20
+    combined.append((int(ys[last_start]), int(xs[last_start]), h, int(last_width)))
+
+    return combined
+
+def _build_pyramid(img, levels):
+    """
+    Build an image pyramid with cv2.pyrDown().
+
+    Args:
+        img: The full resolution image.
+        levels: The number of downscaled levels.
+    Returns:
+        A list of levels + 1 images, starting with the full resolution image.
+    """
+    pyramid = [img]
+    for _ in range(levels):
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+
+    return pyramid
+
+def _match_template_pyramid(img, template, threshold, levels, coarse_threshold_drop=0.25,
+                            page_pyramid=None):
+    """
+    Coarse-to-fine version of cv2.matchTemplate() with TM_CCOEFF_NORMED.
+
+    The template and the image are downscaled by 2**levels and matched with a
+    lowered threshold. Only the regions around the coarse candidates are then
+    matched again at full resolution.
+    Args:
+        img: The image to search in.
+        template: The template to match against.
+        threshold: The threshold that will be applied to the result.
+        levels: The number of pyramid levels to downscale by.
+        coarse_threshold_drop: How much lower the threshold is at the coarse level.
+        page_pyramid: An optional pyramid of img from _build_pyramid(), so that
+            several templates can share the downscaled pages.
+    Returns:
+        An array of the same shape as the full resolution matchTemplate() result.
+        Positions outside the candidate regions are set to -1.
+    """
+    th, tw = template.shape
+
+    # Do not shrink the template below a size that still has some structure.
+    while levels > 0 and min(th, tw) >> levels < 8:
+        levels -= 1
+    if levels == 0:
+        return cv2.matchTemplate(img, template, cv2.TM_CCOEFF_NORMED)
+
+    if page_pyramid is None or len(page_pyramid) <= levels:
+        page_pyramid = _build_pyramid(img, levels)
+    small_template = _build_pyramid(template, levels)[levels]
+    coarse = cv2.matchTemplate(page_pyramid[levels], small_template, cv2.TM_CCOEFF_NORMED)
+
+    res = np.full((img.shape[0] - th + 1, img.shape[1] - tw + 1), -1, dtype=np.float32)
+    candidates = (coarse >= threshold - coarse_threshold_drop).astype(np.uint8)
+    candidates = cv2.dilate(candidates, np.ones((3, 3), np.uint8))
+    num_regions, _, stats, _ = cv2.connectedComponentsWithStats(candidates)
+
+    scale = 1 << levels
+    for cx, cy, cw, ch, _ in stats[1:num_regions]:
+        # Map the coarse region back to full resolution, with a margin of one
+        # coarse pixel for rounding in pyrDown().
+        y0 = max((cy - 1) * scale, 0)
+        x0 = max((cx - 1) * scale, 0)
+        y1 = min((cy + ch + 1) * scale, res.shape[0])
+        x1 = min((cx + cw + 1) * scale, res.shape[1])
+        roi = img[y0:y1 + th - 1, x0:x1 + tw - 1]
+        res[y0:y1, x0:x1] = cv2.matchTemplate(roi, template, cv2.TM_CCOEFF_NORMED)
+
+    return res
+
+def _find_rectangles_for_blanks(img, template, threshold, x_adjust, y_adjust, vectorized=True,
+                                pyramid_levels=0, page_pyramid=None):
     """
     Match the template of the dotted blanks with the blanks in the actual image
     and using matchTemplate() and return boxes that combine all the matched
@@ -77,6 +246,11 @@ def _find_rectangles_for_blanks(img, template, threshold, x_adjust, y_adjust):
         threshold: The threshold for the matchTemplate() function.
         x_adjust: The amount to adjust the x-coordinate of the rectangle.
         y_adjust: The amount to adjust the y-coordinate of the rectangle.
+        vectorized: If True, combine the matches with _combine_rectangles_vectorized(),
+            otherwise use the loop based _combine_rectangles().
+        pyramid_levels: If greater than 0, use coarse-to-fine matching with this
+            many pyramid levels instead of matching the whole full resolution image.
+        page_pyramid: An optional precomputed pyramid of img for pyramid matching.
     Returns:
         A list of tuples (x, y, w, h) for each combined rectangle found.
     """
@@ -87,12 +261,19 @@ def _find_rectangles_for_blanks(img, template, threshold, x_adjust, y_adjust):
     # right, and the y-coordinates increase downwards.
 
     # Corresponds to "1. Match template" in the diagram on the blog post.
-    res = cv2.matchTemplate(img, template, cv2.TM_CCOEFF_NORMED)
+    if pyramid_levels > 0:
+        res = _match_template_pyramid(img, template, threshold, pyramid_levels,
+                                      page_pyramid=page_pyramid)
+    else:
+        res = cv2.matchTemplate(img, template, cv2.TM_CCOEFF_NORMED)
 
     # Therefore, the locations here are a 2D array where the rows indicate the
     # y-coordinates and the columns indicate the x-coordinates.
     loc = np.where(res >= threshold)
-    combined_rectangles = _combine_rectangles(loc, h)
+    if vectorized:
+        combined_rectangles = _combine_rectangles_vectorized(loc, h)
+    else:
+        combined_rectangles = _combine_rectangles(loc, h)
 
     # Adjust the size of the rectangle.
     combined_rectangles = list(map(lambda x: (x[0] + x_adjust, x[1] + y_adjust, x[2], x[3]), 
@@ -100,26 +281,158 @@ def _find_rectangles_for_blanks(img, template, threshold, x_adjust, y_adjust):
 
     return combined_rectangles
 
-def find_form_blanks(png_path, write_image=False):
+def _find_rectangles_for_templates(img, templates, vectorized=True, pyramid_levels=0):
+    """
+    Match several blank templates against the same page and concatenate the
+    results into a single rectangle list.
+
+    Rectangles are ordered by template and then in scanning order, exactly as
+    when matching each template separately, so the rectangle indices bound to
+    the fields in letter_of_guarantee.json stay valid. In pyramid mode the page
+    is downscaled once and the pyramid is shared by all templates; at full
+    resolution each template needs its own matchTemplate() pass.
+    Args:
+        img: The image to search in.
+        templates: A list of (template image, threshold, x_adjust, y_adjust).
+        vectorized: If False, combine matches with the loop based _combine_rectangles().
+        pyramid_levels: If greater than 0, use coarse-to-fine template matching
+            with this many pyramid levels.
+    Returns:
+        A list of tuples (x, y, w, h) for each combined rectangle found.
+    """
+    page_pyramid = _build_pyramid(img, pyramid_levels) if pyramid_levels > 0 else None
+
+    combined_rectangles = []
+    for template, threshold, x_adjust, y_adjust in templates:
+        combined_rectangles += _find_rectangles_for_blanks(img, template, threshold, x_adjust,
+                                                           y_adjust, vectorized, pyramid_levels,
+                                                           page_pyramid)
+
+    return combined_rectangles
+
+@functools.lru_cache(maxsize=None)
+def _load_template(template_path):
+    """
+    Load a blank template as a grayscale image, once per process.
+
+    Args:
+        template_path: The path to the template image.
+    Returns:
+        The grayscale template image.
+    """
+    return cv2.imread(template_path, cv2.IMREAD_GRAYSCALE)
+
+def _layout_fingerprint(img, templates, pyramid_levels=0):
+    """
+    Compute a fingerprint of every input that affects blank detection.
+
+    Args:
+        img: The grayscale page image.
+        templates: A list of (template path, threshold, x_adjust, y_adjust).
+        pyramid_levels: The pyramid levels used for matching.
+    Returns:
+        A hex digest that changes whenever the page, a template image or a
+        detection parameter changes.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"v{_LAYOUT_CACHE_VERSION}:{img.shape}".encode())
+    digest.update(np.ascontiguousarray(img).tobytes())
+    for template_path, threshold, x_adjust, y_adjust in templates:
+        with open(template_path, "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+        digest.update(f"{threshold}:{x_adjust}:{y_adjust}".encode())
+    digest.update(f"pyramid:{pyramid_levels}".encode())
+
+    return digest.hexdigest()
+
+def _load_cached_layout(cache_dir, key):
+    """
+    Load a previously detected layout from the cache.
+
+    Args:
+        cache_dir: The cache directory.
+        key: The layout fingerprint.
+    Returns:
+        A list of tuples (y, x, h, w), or None if the layout is not cached.
+    """
+    cache_path = os.path.join(cache_dir, f"{key}.json")
+    try:
+        with open(cache_path) as f:
+            return [tuple(rect) for rect in json.load(f)]
+    except (OSError, ValueError):
+        return None
+
+def _store_cached_layout(cache_dir, key, rectangles):
+    """
+    Store a detected layout in the cache.
+
+    Args:
+        cache_dir: The cache directory.
+        key: The layout fingerprint.
+        rectangles: A list of tuples (y, x, h, w).
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, f"{key}.json")
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump([[int(v) for v in rect] for rect in rectangles], f)
+    # Atomic so that concurrent runs never read a partially written layout.
+    os.replace(tmp_path, cache_path)
+
+def get_layout_cache_stats():
+    """
+    Returns:
+        A dictionary with the number of layout cache hits and misses.
+    """
+    return dict(layout_cache_stats)
+
+@instrumentation.timed("find_form_blanks")
+def find_form_blanks(page, write_image=False, cache_dir=LAYOUT_CACHE_DIR,
+                     vectorized=True, pyramid_levels=0):
     """
     Find the blanks in the form image by matching the template of the dotted
     blanks with the blanks in the actual image and return boxes that combine
     all the matched boxes for a given blank.
+
+    The detected layout is cached on disk, keyed by a fingerprint of the page
+    pixels, the template images and the detection parameters, so an unchanged
+    form is only matched once.
     Args:
-        png_path: The path to the PNG image of the form.
+        page: The path to the PNG image of the form, or the grayscale page
+            image itself, e.g. from render_pdf_page().
         write_image: If True, write the image with the rectangles drawn on it.
+        cache_dir: The layout cache directory. None disables the cache.
+        vectorized: If False, combine matches with the loop based _combine_rectangles().
+        pyramid_levels: If greater than 0, use coarse-to-fine template matching
+            with this many pyramid levels.
     Returns:
         A list of tuples (x, y, w, h) for each combined rectangle found.
     """
-    img = cv2.imread(png_path, cv2.IMREAD_GRAYSCALE)
-    template = cv2.imread("dots.png", cv2.IMREAD_GRAYSCALE)
-    template2 = cv2.imread("dots2.png", cv2.IMREAD_GRAYSCALE)
-    threshold = 0.9
+    if isinstance(page, np.ndarray):
+        img = page
+        overlay_path = "overlay_blanks.png"
+    else:
+        img = cv2.imread(page, cv2.IMREAD_GRAYSCALE)
+        overlay_path = f"overlay_{page}"
+
+    combined_rectangles = None
+    if cache_dir is not None:
+        key = _layout_fingerprint(img, BLANK_TEMPLATES, pyramid_levels)
+        combined_rectangles = _load_cached_layout(cache_dir, key)
 
-    combined_rectangles = _find_rectangles_for_blanks(img, template, threshold, 20, 20)
-    combined_rectangles += _find_rectangles_for_blanks(img, template2, threshold, 15, 15)
+    if combined_rectangles is not None:
+        layout_cache_stats["hits"] += 1
+    else:
+        layout_cache_stats["misses"] += 1
+        templates = [(_load_template(template_path), threshold, x_adjust, y_adjust)
+                     for template_path, threshold, x_adjust, y_adjust in BLANK_TEMPLATES]
+        combined_rectangles = _find_rectangles_for_templates(img, templates, vectorized,
+                                                             pyramid_levels)
+        if cache_dir is not None:
+            _store_cached_layout(cache_dir, key, combined_rectangles)
 
     if write_image:
+        img = img.copy()
         i = 0
         for pt in combined_rectangles:  # Switch columns and rows
             # cv2.rectangle(img, (pt[1], pt[0]), (pt[1] + pt[3], pt[0] + pt[2]), (0, 255, 0), 2)
@@ -128,6 +441,6 @@ def find_form_blanks(png_path, write_image=False):
                         cv2.LINE_AA)
             i+= 1
             
-        cv2.imwrite(f"overlay_{png_path}", img)
+        cv2.imwrite(overlay_path, img)
 
     return combined_rectangles
\ No newline at end of file
@@ -0,0 +1,117 @@
+"""
+session_store.py
+
+Persistent snapshots of chat sessions, so that an applicant can resume a
+form after the process serving them restarts.
+
+A session is stored as its validated field values only, one entry per field,
+written as soon as the field is saved. The position in the form is derived
+from them when the session is resumed, so every turn costs one small write
+regardless of the length of the form, and no validated answer is ever sent
+to the model again.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+# Default location of the SQLite session store.
+SESSION_STORE_PATH = ".sessions.sqlite"
+
+class DictSessionStore:
+    """
+    Session store kept in process memory, e.g. for tests or a single worker.
+    """
+    def __init__(self):
+        self._sessions = dict()
+
+    def save_field(self, session_id, field_name, value):
+        """
+        Stores the validated value of one field, registering the session on
+        its first field.
+
+        Args:
+            session_id (str): The session id.
+            field_name (str): The dot-separated field name.
+            value: The saved value, which must be JSON serializable.
+        """
+        self._sessions.setdefault(session_id, dict())[field_name] = value
+
+    def load(self, session_id):
+        """
+        Args:
+            session_id (str): The session id.
+
+        Returns:
+            dict: The saved values by dot-separated field name, or None if the
+            session does not exist.
+        """
+        fields = self._sessions.get(session_id)
+        return None if fields is None else dict(fields)
+
+    def delete(self, session_id):
+        self._sessions.pop(session_id, None)
+
+class SQLiteSessionStore:
+    """
+    Session store backed by SQLite, shared by every process using the same file.
+    """
+    def __init__(self, path=SESSION_STORE_PATH):
+        """
+        Args:
+            path (str): The SQLite file. ":memory:" keeps the store in process only.
+        """
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                         "session_id TEXT PRIMARY KEY, created_at REAL NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS fields ("
+                         "session_id TEXT NOT NULL, field_name TEXT NOT NULL, "
+                         "value TEXT NOT NULL, updated_at REAL NOT NULL, "
+                         "PRIMARY KEY (session_id, field_name))")
+        self._db.commit()
+
+    def save_field(self, session_id, field_name, value):
+        """
+        Stores the validated value of one field, registering the session on
+        its first field.
+
+        Args:
+            session_id (str): The session id.
+            field_name (str): The dot-separated field name.
+            value: The saved value, which must be JSON serializable.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO sessions VALUES (?, ?)", (session_id, now))
+            self._db.execute("INSERT OR REPLACE INTO fields VALUES (?, ?, ?, ?)",
+                             (session_id, field_name, json.dumps(value), now))
+            self._db.commit()
+
+    def load(self, session_id):
+        """
+        Args:
+            session_id (str): The session id.
+
+        Returns:
+            dict: The saved values by dot-separated field name, or None if the
+            session does not exist.
+        """
+        with self._lock:
+            if self._db.execute("SELECT 1 FROM sessions WHERE session_id = ?",
+                                (session_id,)).fetchone() is None:
+                return None
+            rows = self._db.execute("SELECT field_name, value FROM fields WHERE session_id = ?",
+                                    (session_id,)).fetchall()
+
+        return {field_name: json.loads(value) for field_name, value in rows}
+
+    def delete(self, session_id):
+        with self._lock:
+            self._db.execute("DELETE FROM fields WHERE session_id = ?", (session_id,))
+            self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,56 @@
+"""
+test_pdf_utils.py
+
+Checks that _combine_rectangles_vectorized() returns the same rectangles as
+the loop based _combine_rectangles() it replaces.
+
+Usage:
+    python -m pytest test_pdf_utils.py
+"""
+
+import numpy as np
+import pytest
+from pdf_utils import _combine_rectangles, _combine_rectangles_vectorized
+
+def _loop_rectangles(ys, xs, h=40):
+    """
+    Returns:
+        list: The rectangles of _combine_rectangles() as tuples of ints.
+    """
+    return [tuple(map(int, rect)) for rect in _combine_rectangles((ys, xs), h)]
+
+def test_empty_input():
+    # The loop based version fails on an empty match, the vectorized one finds nothing.
+    loc = (np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+    assert _combine_rectangles_vectorized(loc, 40) == []
+
+@pytest.mark.parametrize("ys, xs", [
+    # A single point.
+    ([7], [3]),
+    # Two far apart points, the second one closing the rectangle.
+    ([7, 7], [0, 50]),
+    # A run ending on a closing point.
+    ([7, 7, 7, 7], [0, 1, 2, 50]),
+    # Consecutive closing points, of which only every other one takes effect.
+    ([7, 7, 7, 7, 7], [0, 20, 40, 60, 80]),
+    ([7, 7, 7, 7, 7, 7], [0, 20, 40, 60, 80, 100]),
+    # Row changes, including on the second and the last point.
+    ([5, 5, 6, 6], [0, 1, 0, 1]),
+    ([5, 6, 6, 6], [0, 0, 1, 2]),
+    ([5, 5, 5, 6], [0, 1, 2, 0]),
+    ([5, 6, 7, 8], [0, 0, 0, 0]),
+    # A row change right after a closing point.
+    ([5, 5, 5, 6, 6], [0, 1, 40, 0, 1]),
+])
+def test_matches_loop(ys, xs):
+    ys, xs = np.array(ys), np.array(xs)
+    assert _combine_rectangles_vectorized((ys, xs), 40) == _loop_rectangles(ys, xs)
+
+@pytest.mark.parametrize("seed", range(20))
+def test_matches_loop_on_random_match_maps(seed):
+    rng = np.random.default_rng(seed)
+    match_map = rng.random((30, 200)) < rng.uniform(0.02, 0.5)
+    ys, xs = np.where(match_map)
+    if len(ys) == 0:
+        pytest.skip("empty match map")
+    assert _combine_rectangles_vectorized((ys, xs), 40) == _loop_rectangles(ys, xs)
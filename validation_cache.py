@@ -0,0 +1,180 @@
+"""
+validation_cache.py
+
+A bounded, persistent cache for model validation responses.
+
+Many applicants give the same answers (nationalities, relationships, statuses
+of residence), so the ChatInfo returned by the model for a field and an input
+can be reused instead of running the local model again. Only fields marked
+"cacheable" in the form definition are cached, since free-text answers such
+as names, addresses and phone numbers are personal data that is neither
+shared between applicants nor written to disk. Entries are kept in an
+in-memory LRU in front of a SQLite table, and expire after a TTL. The last use
+of an entry is written to SQLite in batches, not on every hit.
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Default location of the SQLite cache file.
+VALIDATION_CACHE_PATH = ".validation_cache.sqlite"
+
+def normalize_input(user_input):
+    """
+    Normalizes user input so that trivially different answers share an entry.
+    Only the categorical answers of cacheable fields are cached, so case never
+    carries meaning here.
+
+    Args:
+        user_input (str): The user's input.
+
+    Returns:
+        str: The input case folded, with whitespace collapsed.
+    """
+    return " ".join(user_input.casefold().split())
+
+class ValidationCache:
+    """
+    LRU cache in memory, backed by SQLite, of model responses keyed by model
+    name, field description, validation rule and normalized user input.
+    """
+    def __init__(self, path=VALIDATION_CACHE_PATH, max_entries=10000, max_memory_entries=1000,
+                 ttl_seconds=30 * 24 * 3600, touch_batch_size=100):
+        """
+        Args:
+            path (str): The SQLite file. ":memory:" keeps the cache in process only.
+            max_entries (int): The maximum number of entries kept in SQLite.
+            max_memory_entries (int): The maximum number of entries kept in memory.
+            ttl_seconds (float): How long an entry stays valid.
+            touch_batch_size (int): The number of hits after which their last
+                use is written to SQLite. It is also written on put() and close().
+        """
+        self.max_entries = max_entries
+        self.max_memory_entries = max_memory_entries
+        self.ttl_seconds = ttl_seconds
+        self.touch_batch_size = touch_batch_size
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._touched = dict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                         "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                         "created_at REAL NOT NULL, last_used REAL NOT NULL)")
+        self._db.commit()
+
+    @staticmethod
+    def make_key(model_name, field_data, user_input):
+        """
+        Args:
+            model_name (str): The model, or the comma-separated models of the
+                retry policy, that produced the response.
+            field_data (FormField): The compiled field.
+            user_input (str): The user's input.
+
+        Returns:
+            str: The cache key.
+        """
+        digest = hashlib.sha256()
+        for part in (model_name, field_data.description, field_data.validation_rule,
+                     normalize_input(user_input)):
+            digest.update(part.encode())
+            digest.update(b"\0")
+
+        return digest.hexdigest()
+
+    def get(self, key, response_model):
+        """
+        Looks up a cached response.
+
+        Args:
+            key (str): The cache key from make_key().
+            response_model: The pydantic model to load the response into.
+
+        Returns:
+            A fresh instance of response_model, or None on a miss.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                row = self._db.execute("SELECT value, created_at FROM responses WHERE key = ?",
+                                       (key,)).fetchone()
+                if row is not None:
+                    entry = row
+            if entry is not None and now - entry[1] > self.ttl_seconds:
+                self._memory.pop(key, None)
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._remember(key, entry)
+            self._touched[key] = now
+            if len(self._touched) >= self.touch_batch_size:
+                self._write_touched()
+                self._db.commit()
+
+        return response_model.model_validate_json(entry[0])
+
+    def put(self, key, response):
+        """
+        Stores a response, evicting the least recently used entries when full.
+
+        Args:
+            key (str): The cache key from make_key().
+            response: The pydantic model instance returned by the model.
+        """
+        now = time.time()
+        entry = (response.model_dump_json(), now)
+        with self._lock:
+            self._remember(key, entry)
+            # The eviction below needs the last use of every entry.
+            self._write_touched()
+            self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                             (key, entry[0], now, now))
+            self._db.execute("DELETE FROM responses WHERE key IN ("
+                             "SELECT key FROM responses ORDER BY last_used DESC "
+                             "LIMIT -1 OFFSET ?)", (self.max_entries,))
+            self._db.commit()
+
+    def _write_touched(self):
+        """
+        Writes the last use of the entries hit since the last write, without committing.
+        """
+        if self._touched:
+            self._db.executemany("UPDATE responses SET last_used = ? WHERE key = ?",
+                                 [(last_used, key) for key, last_used in self._touched.items()])
+            self._touched.clear()
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self):
+        """
+        Returns:
+            dict: The number of hits and misses, and the hit rate.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._write_touched()
+            self._db.commit()
+            self._db.close()